@@ -0,0 +1,174 @@
+"""Analytics de consultas e do funil com escrita em lote (write-behind)
+
+Os eventos não são gravados no banco na hora: cada processo agrega
+contadores por (dia, evento, chave) em memória e uma thread em segundo
+plano os grava com um upsert em lote a cada `intervalo` segundos ou quando
+o buffer atinge `max_chaves` chaves. Ao encerrar o processo (atexit), o
+que estiver no buffer é gravado.
+"""
+import atexit
+import os
+import sys
+import threading
+from collections import Counter
+from datetime import date
+
+from sqlalchemy import text
+
+# Etapas do funil, na ordem
+ETAPAS_FUNIL = ('consulta', 'lead', 'resultado', 'simulacao')
+
+_SQL_UPSERT = text('''
+    INSERT INTO analytics_contadores (dia, evento, chave, total)
+    VALUES (:dia, :evento, :chave, :total)
+    ON CONFLICT (dia, evento, chave) DO UPDATE SET total = total + excluded.total
+''')
+
+
+class EventBuffer:
+    """Contadores de eventos agregados em memória e gravados em lote no banco
+
+    `conectar` é uma função que retorna uma conexão SQLAlchemy. A memória é
+    limitada: se o banco ficar indisponível e o buffer chegar ao dobro de
+    `max_chaves`, eventos de chaves novas são descartados (e contados em
+    `descartados`) até o próximo flush bem-sucedido.
+    """
+
+    def __init__(self, conectar, intervalo=30, max_chaves=10000):
+        self._conectar = conectar
+        self.intervalo = intervalo
+        self.max_chaves = max_chaves
+        self.descartados = 0
+        self._contadores = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._acordar = threading.Event()
+        self._parar = threading.Event()
+        self._thread = None
+        self._pid = None
+        # Serializa a inicialização por processo: sem ela, duas primeiras
+        # requisições concorrentes (gthread) iniciariam duas threads de flush
+        self._init_lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._apos_fork)
+        atexit.register(self.parar)
+
+    def _apos_fork(self):
+        """No filho, descarta locks e contadores copiados do processo pai"""
+        self._init_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._contadores = Counter()
+        self._thread = None
+        self._pid = None
+
+    def iniciar(self):
+        """Inicia a thread de flush no processo atual (após um fork, no worker)
+
+        Idempotente e segura entre threads. `_pid` só é atualizado depois que
+        o buffer do processo está pronto, então nenhuma thread conta eventos
+        em um Counter que ainda vai ser substituído.
+        """
+        with self._init_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._flush_lock = threading.Lock()
+            self._contadores = Counter()
+            self._thread = threading.Thread(target=self._loop, name='analytics-flush', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def registrar(self, evento, chave=''):
+        """Conta um evento; custo de um incremento em memória"""
+        if self._pid != os.getpid():
+            self.iniciar()
+
+        item = (date.today().isoformat(), evento, chave or '')
+        with self._lock:
+            if item not in self._contadores and len(self._contadores) >= 2 * self.max_chaves:
+                self.descartados += 1
+                return
+            self._contadores[item] += 1
+            cheio = len(self._contadores) >= self.max_chaves
+
+        if cheio:
+            self._acordar.set()
+
+    def _loop(self):
+        while not self._parar.is_set():
+            self._acordar.wait(self.intervalo)
+            self._acordar.clear()
+            self.flush()
+
+    def flush(self):
+        """Grava os contadores acumulados em um único upsert em lote"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._contadores:
+                    return 0
+                lote, self._contadores = self._contadores, Counter()
+
+            parametros = [
+                {'dia': dia, 'evento': evento, 'chave': chave, 'total': total}
+                for (dia, evento, chave), total in lote.items()
+            ]
+            try:
+                conn = self._conectar()
+                try:
+                    conn.execute(_SQL_UPSERT, parametros)
+                    conn.commit()
+                finally:
+                    conn.close()
+            except Exception as e:
+                # Devolve os contadores ao buffer para a próxima tentativa
+                with self._lock:
+                    self._contadores.update(lote)
+                print(f"⚠️  Erro ao gravar analytics ({len(parametros)} contadores mantidos em memória): {e}", file=sys.stderr)
+                return 0
+
+            return len(parametros)
+
+    def parar(self):
+        """Para a thread e grava o que estiver no buffer (encerramento gracioso)"""
+        self._parar.set()
+        self._acordar.set()
+        if self._pid == os.getpid():
+            self.flush()
+
+
+def top_chaves(conn, evento, desde, limite):
+    """Chaves mais frequentes de um evento desde a data"""
+    rows = conn.execute(
+        text('''
+            SELECT chave, SUM(total) AS total FROM analytics_contadores
+            WHERE evento = :evento AND dia >= :desde
+            GROUP BY chave
+            ORDER BY total DESC, chave
+            LIMIT :limite
+        '''),
+        {'evento': evento, 'desde': desde.isoformat(), 'limite': limite}
+    ).fetchall()
+    return [{'chave': row[0], 'total': row[1]} for row in rows]
+
+
+def funil(conn, desde):
+    """Total de cada etapa do funil e a conversão de uma etapa para a seguinte"""
+    rows = conn.execute(
+        text('''
+            SELECT chave, SUM(total) FROM analytics_contadores
+            WHERE evento = 'funil' AND dia >= :desde
+            GROUP BY chave
+        '''),
+        {'desde': desde.isoformat()}
+    ).fetchall()
+    totais = dict(rows)
+
+    etapas = []
+    anterior = None
+    for etapa in ETAPAS_FUNIL:
+        total = totais.get(etapa, 0)
+        conversao = round(total / anterior, 4) if anterior else None
+        etapas.append({'etapa': etapa, 'total': total, 'conversao': conversao})
+        anterior = total
+    return etapas
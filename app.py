@@ -1,70 +1,407 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
+from flask import (Blueprint, Flask, Response, current_app, render_template, request, jsonify,
+                   session, redirect, stream_with_context, url_for)
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import StaticPool
-from datetime import timedelta
+from sqlalchemy import bindparam, text
+from sqlalchemy.pool import NullPool
+from datetime import date, timedelta
+from functools import wraps
+import click
+import hmac
+import io
 import secrets
+import signal
+import sys
+import threading
 import os
-from dotenv import load_dotenv
-
-# Carrega variáveis de ambiente
-load_dotenv()
-
-app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
-
-# Configuração de sessão permanente
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
-app.config['SESSION_COOKIE_SECURE'] = False  # True em produção com HTTPS
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-
-# Configuração do Turso Database
-TURSO_DATABASE_URL = os.getenv('TURSO_DATABASE_URL')
-TURSO_AUTH_TOKEN = os.getenv('TURSO_AUTH_TOKEN')
-
-# Cria engine do SQLAlchemy com Turso
-if TURSO_DATABASE_URL and TURSO_AUTH_TOKEN:
-    # Remove o protocolo libsql:// se estiver presente
-    url_without_protocol = TURSO_DATABASE_URL.replace('libsql://', '')
-    db_url = f"sqlite+libsql://{url_without_protocol}?secure=true"
-
-    engine = create_engine(
-        db_url,
-        connect_args={
-            'check_same_thread': False,
-            'auth_token': TURSO_AUTH_TOKEN
-        },
-        poolclass=StaticPool,
-        echo=False
-    )
-    print("✅ Conectado ao Turso Database")
-else:
-    print("⚠️  Variáveis TURSO_DATABASE_URL e TURSO_AUTH_TOKEN não configuradas")
-    print("⚠️  Configure o .env com suas credenciais do Turso")
-    engine = None
-
-# Configuração do Resend
-RESEND_API_KEY = os.getenv('RESEND_API_KEY')
-FROM_EMAIL = os.getenv('FROM_EMAIL', 'onboarding@resend.dev')
-FROM_NAME = os.getenv('FROM_NAME', 'Conta Azul - Crédito Tributário')
-
-# Importa Resend apenas se a chave estiver configurada
-resend_available = False
-if RESEND_API_KEY:
-    try:
-        import resend
-        resend.api_key = RESEND_API_KEY
-        resend_available = True
-    except ImportError:
-        print("⚠️  Resend não instalado. Execute: pip install resend")
+
+import analytics
+from catalogo import ler_catalogo_csv, reclassificar_vencidos, salvar_catalogo
+from db import build_engine
+import leads_export
+import leads_import
+from memoria import uso_memoria
+from ncm_index import SNAPSHOT_PATH_PADRAO, NcmIndex, SnapshotInvalido, ler_versao_dataset, migrar_vigencias
+from normalizacao import ancestrais, com_zero_a_esquerda, normalizar_ncm
+
+# cli_group=None: os comandos do blueprint ficam no nível raiz (flask --app app <comando>)
+bp = Blueprint('main', __name__, cli_group=None)
+
+# Protege a criação preguiçosa da engine e do cliente de email entre threads
+_init_lock = threading.Lock()
+
+# Garante que só uma thread por processo verifica/recarrega o dataset por vez
+_reload_lock = threading.Lock()
+
+# Configuração padrão, sobrescrita pelo .env ou pelo dict passado ao create_app
+DEFAULT_CONFIG = {
+    # Configuração de sessão permanente
+    'PERMANENT_SESSION_LIFETIME': timedelta(days=30),
+    'SESSION_COOKIE_SECURE': False,  # True em produção com HTTPS
+    'SESSION_COOKIE_HTTPONLY': True,
+    'SESSION_COOKIE_SAMESITE': 'Lax',
+    # Configuração do Turso Database (DATABASE_URL permite usar um SQLite local)
+    'TURSO_DATABASE_URL': None,
+    'TURSO_AUTH_TOKEN': None,
+    'DATABASE_URL': None,
+    # Token do acesso administrativo (Authorization: Bearer <token>); vazio desativa
+    'ADMIN_TOKEN': None,
+    # Configuração do Resend
+    'RESEND_API_KEY': None,
+    'FROM_EMAIL': 'onboarding@resend.dev',
+    'FROM_NAME': 'Conta Azul - Crédito Tributário',
+    # Aquece a instância (pool, NCMs e templates) dentro do create_app
+    'WARMUP': True,
+    # Intervalo (s) entre novas tentativas de warm-up enquanto a instância não está pronta
+    'WARMUP_RETRY_INTERVAL': 5,
+    # Intervalo (s) entre verificações de nova versão do dataset NCM (0 desativa)
+    'NCM_RELOAD_INTERVAL': 60,
+    # Snapshot compilado gerado pelo import_csv.py (vazio desativa)
+    'NCM_SNAPSHOT_PATH': SNAPSHOT_PATH_PADRAO,
+    # Analytics de consultas e do funil: intervalo (s) entre gravações em lote e
+    # máximo de contadores distintos em memória antes de forçar a gravação
+    'ANALYTICS_ENABLED': True,
+    'ANALYTICS_FLUSH_INTERVAL': 30,
+    'ANALYTICS_MAX_CHAVES': 10000,
+}
+
+def config_from_env():
+    """Lê a configuração das variáveis de ambiente (carregando o .env)"""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    config = {
+        'SECRET_KEY': os.getenv('SECRET_KEY') or secrets.token_hex(16),
+        'WARMUP': os.getenv('WARMUP', '1') != '0',
+        'NCM_RELOAD_INTERVAL': int(os.getenv('NCM_RELOAD_INTERVAL', DEFAULT_CONFIG['NCM_RELOAD_INTERVAL'])),
+        'ANALYTICS_ENABLED': os.getenv('ANALYTICS_ENABLED', '1') != '0',
+        'ANALYTICS_FLUSH_INTERVAL': float(os.getenv('ANALYTICS_FLUSH_INTERVAL', DEFAULT_CONFIG['ANALYTICS_FLUSH_INTERVAL'])),
+        'ANALYTICS_MAX_CHAVES': int(os.getenv('ANALYTICS_MAX_CHAVES', DEFAULT_CONFIG['ANALYTICS_MAX_CHAVES'])),
+    }
+    for key in ('TURSO_DATABASE_URL', 'TURSO_AUTH_TOKEN', 'DATABASE_URL',
+                'RESEND_API_KEY', 'FROM_EMAIL', 'FROM_NAME', 'NCM_SNAPSHOT_PATH', 'ADMIN_TOKEN'):
+        if os.getenv(key):
+            config[key] = os.getenv(key)
+    return config
+
+def create_app(config=None):
+    """Cria a aplicação Flask
+
+    Sem `config`, a configuração vem do .env. A engine do banco e o cliente
+    de email só são criados no primeiro uso (ou no warm-up).
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config_from_env() if config is None else config)
+    if not app.config.get('SECRET_KEY'):
+        app.secret_key = secrets.token_hex(16)
+
+    app.extensions['mapeador'] = {
+        'engine': None,
+        'email_client': None,
+        'ncm_index': None,
+        'ready': False,
+        'warmup_ms': None,
+        'ultima_tentativa_warmup': None,
+        'ultima_verificacao': time.monotonic(),
+        'recarregar': False,
+        'analytics': None,
+        'analytics_engine': None,
+    }
+    if app.config['ANALYTICS_ENABLED']:
+        # A thread de gravação só é iniciada no primeiro evento de cada processo (após o fork)
+        app.extensions['mapeador']['analytics'] = analytics.EventBuffer(
+            lambda: _conectar_analytics(app),
+            intervalo=app.config['ANALYTICS_FLUSH_INTERVAL'],
+            max_chaves=app.config['ANALYTICS_MAX_CHAVES']
+        )
+    app.register_blueprint(bp)
+
+    if threading.current_thread() is threading.main_thread():
+        install_reload_signal(app)
+
+    if app.config['WARMUP']:
+        warm_up(app)
+
+    return app
+
+def _state(app=None):
+    """Estado da instância guardado em app.extensions"""
+    return (app or current_app).extensions['mapeador']
+
+def get_engine():
+    """Retorna a engine do SQLAlchemy, criando-a no primeiro uso"""
+    state = _state()
+    if state['engine'] is None:
+        with _init_lock:
+            if state['engine'] is None:
+                state['engine'] = build_engine(
+                    turso_database_url=current_app.config['TURSO_DATABASE_URL'],
+                    turso_auth_token=current_app.config['TURSO_AUTH_TOKEN'],
+                    database_url=current_app.config['DATABASE_URL']
+                )
+    return state['engine']
+
+def get_email_client():
+    """Retorna o módulo resend configurado, ou None se o envio de email não estiver disponível"""
+    state = _state()
+    if state['email_client'] is None and current_app.config['RESEND_API_KEY']:
+        with _init_lock:
+            if state['email_client'] is None:
+                try:
+                    import resend
+                except ImportError:
+                    print("⚠️  Resend não instalado. Execute: pip install resend", file=sys.stderr)
+                    return None
+                resend.api_key = current_app.config['RESEND_API_KEY']
+                state['email_client'] = resend
+    return state['email_client']
 
 def get_db_connection():
     """Conecta ao banco de dados Turso via SQLAlchemy"""
+    engine = get_engine()
     if engine is None:
         raise Exception("Database engine não configurado. Verifique as variáveis de ambiente TURSO_DATABASE_URL e TURSO_AUTH_TOKEN")
     return engine.connect()
 
+def _conectar_analytics(app):
+    """Conexão da thread de analytics, por uma engine própria
+
+    A engine da aplicação usa StaticPool, que entrega a mesma conexão DBAPI
+    a todas as threads: o commit (e o rollback do close) da thread de
+    analytics atingiria transações em andamento nas requisições. A engine
+    de analytics usa NullPool, com uma conexão nova a cada gravação.
+    """
+    state = _state(app)
+    if state['analytics_engine'] is None:
+        with _init_lock:
+            if state['analytics_engine'] is None:
+                state['analytics_engine'] = build_engine(
+                    turso_database_url=app.config['TURSO_DATABASE_URL'],
+                    turso_auth_token=app.config['TURSO_AUTH_TOKEN'],
+                    database_url=app.config['DATABASE_URL'],
+                    poolclass=NullPool
+                )
+    if state['analytics_engine'] is None:
+        raise Exception("Database engine não configurado. Verifique as variáveis de ambiente TURSO_DATABASE_URL e TURSO_AUTH_TOKEN")
+    return state['analytics_engine'].connect()
+
+def release_connections(app):
+    """Fecha as conexões abertas pela engine (ex: no master, antes do fork)
+
+    A engine continua válida: a próxima conexão é aberta sob demanda no
+    processo que a usar.
+    """
+    engine = _state(app)['engine']
+    if engine is not None:
+        engine.dispose()
+
+def iniciar_analytics(app):
+    """Inicia a thread de flush de analytics no processo atual (ex: ao iniciar o worker)"""
+    buffer = _state(app)['analytics']
+    if buffer is not None:
+        buffer.iniciar()
+
+def flush_analytics(app):
+    """Grava os contadores de analytics pendentes (ex: no encerramento do worker)"""
+    buffer = _state(app)['analytics']
+    if buffer is not None:
+        buffer.parar()
+
+def get_ncm_index():
+    """Índice de NCMs carregado no warm-up, ou None se ainda não foi carregado"""
+    return _state()['ncm_index']
+
+def carregar_indice_ncm(conn, meta):
+    """Monta o índice de NCMs da versão `meta` do dataset
+
+    Usa o snapshot compilado (mmap, carga em milissegundos) quando ele está
+    íntegro e na mesma versão do banco; caso contrário, lê a tabela ncm.
+    """
+    path = current_app.config['NCM_SNAPSHOT_PATH']
+    if path and os.path.exists(path):
+        try:
+            indice = NcmIndex.load_snapshot(path)
+        except SnapshotInvalido as e:
+            print(f"⚠️  {e}; carregando NCMs do banco", file=sys.stderr)
+        else:
+            if meta is None or indice.versao == meta['versao']:
+                return indice
+            print(f"⚠️  Snapshot na versão {indice.versao} e banco na versão {meta['versao']}; carregando NCMs do banco", file=sys.stderr)
+
+    return NcmIndex.from_connection(conn)
+
+def warm_up(app):
+    """Aquece a instância antes de reportá-la como pronta
+
+    Abre a conexão do pool, carrega os NCMs em memória e pré-compila todos
+    os templates Jinja (header.html, steps.html, footer.html, ...).
+    """
+    inicio = time.perf_counter()
+    state = _state(app)
+    state['ultima_tentativa_warmup'] = time.monotonic()
+
+    with app.app_context():
+        # Compila os templates e guarda no cache do Jinja
+        for template in app.jinja_env.list_templates():
+            app.jinja_env.get_template(template)
+
+        try:
+            conn = get_db_connection()
+            try:
+                conn.execute(text('SELECT 1'))
+                # Banco ainda no esquema anterior às vigências (import_csv.py não rodou)
+                if migrar_vigencias(conn):
+                    conn.commit()
+                    print("🔧 Colunas de vigência acrescentadas à tabela ncm", file=sys.stderr)
+                state['ncm_index'] = carregar_indice_ncm(conn, ler_versao_dataset(conn))
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"⚠️  Warm-up incompleto, instância não está pronta: {e}", file=sys.stderr)
+            return False
+
+    state['warmup_ms'] = round((time.perf_counter() - inicio) * 1000, 1)
+    state['ready'] = True
+    print(f"✅ Instância aquecida em {state['warmup_ms']} ms "
+          f"({len(state['ncm_index'])} registros NCM, {state['ncm_index'].nbytes() // 1024} KB, "
+          f"origem: {state['ncm_index'].origem})", file=sys.stderr)
+    return True
+
+def tentar_warm_up(app):
+    """Refaz o warm-up enquanto a instância não está pronta
+
+    Cobre a falha do warm-up no create_app (ex: erro transitório do Turso
+    no boot) e o WARMUP=0, em que o primeiro warm-up acontece aqui. Tenta no
+    máximo uma vez a cada WARMUP_RETRY_INTERVAL segundos, em uma thread por vez.
+    """
+    state = _state(app)
+    ultima = state['ultima_tentativa_warmup']
+    if ultima is not None and time.monotonic() - ultima < app.config['WARMUP_RETRY_INTERVAL']:
+        return False
+    if not _reload_lock.acquire(blocking=False):
+        return False  # Outra thread já está tentando
+
+    try:
+        if state['ready']:
+            return False
+        return warm_up(app)
+    finally:
+        _reload_lock.release()
+
+def verificar_dataset(app):
+    """Troca o índice de NCMs se o import_csv.py publicou uma nova versão
+
+    A verificação é uma consulta leve em `dataset_meta`, feita no máximo uma
+    vez a cada NCM_RELOAD_INTERVAL segundos (ou logo após um SIGUSR2). O novo
+    índice é montado ao lado do atual e trocado com uma única atribuição:
+    requisições em andamento continuam usando o índice que já pegaram.
+    Enquanto a instância não está pronta, tenta o warm-up de novo.
+    """
+    state = _state(app)
+    intervalo = app.config['NCM_RELOAD_INTERVAL']
+    agora = time.monotonic()
+
+    if not state['ready'] or state['ncm_index'] is None:
+        return tentar_warm_up(app)
+    if not state['recarregar'] and (not intervalo or agora - state['ultima_verificacao'] < intervalo):
+        return False
+    if not _reload_lock.acquire(blocking=False):
+        return False  # Outra thread já está verificando
+
+    try:
+        state['recarregar'] = False
+        state['ultima_verificacao'] = agora
+
+        with app.app_context():
+            conn = get_db_connection()
+            try:
+                meta = ler_versao_dataset(conn)
+                if meta is None or meta['versao'] == state['ncm_index'].versao:
+                    return False
+                novo_indice = carregar_indice_ncm(conn, meta)
+            finally:
+                conn.close()
+
+        versao_anterior = state['ncm_index'].versao
+        state['ncm_index'] = novo_indice
+        print(f"🔄 Dataset NCM recarregado: versão {versao_anterior} → {novo_indice.versao}", file=sys.stderr)
+        return True
+
+    except Exception as e:
+        print(f"⚠️  Erro ao verificar versão do dataset NCM: {e}", file=sys.stderr)
+        return False
+    finally:
+        _reload_lock.release()
+
+def install_reload_signal(app):
+    """Faz o SIGUSR2 forçar a verificação do dataset na próxima requisição"""
+    if not hasattr(signal, 'SIGUSR2'):
+        return
+
+    def _solicitar_recarga(signum, frame):
+        _state(app)['recarregar'] = True
+
+    signal.signal(signal.SIGUSR2, _solicitar_recarga)
+
+def dataset_version():
+    """Versão do dataset NCM em uso por este processo, ou None"""
+    indice = get_ncm_index()
+    return indice.versao if indice is not None else None
+
+@bp.before_app_request
+def _verificar_dataset():
+    verificar_dataset(current_app._get_current_object())
+
+@bp.after_app_request
+def _header_versao_dataset(response):
+    versao = dataset_version()
+    if versao is not None:
+        response.headers['X-Dataset-Version'] = str(versao)
+    return response
+
+def registrar_evento(evento, chave):
+    """Conta um evento de analytics (gravado em lote, fora da requisição); chaves vazias são ignoradas"""
+    buffer = _state()['analytics']
+    if buffer is not None and chave:
+        buffer.registrar(evento, chave)
+
+def registrar_etapa_funil(etapa):
+    """Conta uma etapa do funil uma vez por sessão (recarregar a página não conta de novo)"""
+    etapas = session.get('funil', [])
+    if etapa not in etapas:
+        session['funil'] = etapas + [etapa]
+        registrar_evento('funil', etapa)
+
+def parse_data_referencia(valor):
+    """Data de referência das regras (texto AAAA-MM-DD); hoje, se omitida
+
+    Levanta ValueError se o valor não for uma data nesse formato (ex: um número no JSON).
+    """
+    if not valor:
+        return date.today()
+    if not isinstance(valor, str):
+        raise ValueError(f"Data de referência inválida: {valor!r}")
+    return date.fromisoformat(valor)
+
+def admin_required(view):
+    """Exige o header Authorization: Bearer <ADMIN_TOKEN> nas rotas administrativas"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config['ADMIN_TOKEN']
+        if not token:
+            return jsonify({'error': 'Acesso administrativo não configurado'}), 403
+
+        enviado = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(enviado.encode('utf-8'), f'Bearer {token}'.encode('utf-8')):
+            return jsonify({'error': 'Não autorizado'}), 401
+
+        return view(*args, **kwargs)
+    return wrapper
+
 def row_to_dict(row):
     """Converte Row do SQLAlchemy para dicionário"""
     if row is None:
@@ -73,8 +410,9 @@ def row_to_dict(row):
 
 def send_welcome_email(email, nome, senha_original, ncm_data):
     """Envia email de boas-vindas com credenciais"""
-    if not resend_available:
-        print(f"⚠️  Email não enviado (Resend não configurado) para {email}")
+    resend = get_email_client()
+    if resend is None:
+        print(f"⚠️  Email não enviado (Resend não configurado) para {email}", file=sys.stderr)
         return False
 
     try:
@@ -121,21 +459,67 @@ def send_welcome_email(email, nome, senha_original, ncm_data):
         """
 
         params = {
-            "from": f"{FROM_NAME} <{FROM_EMAIL}>",
+            "from": f"{current_app.config['FROM_NAME']} <{current_app.config['FROM_EMAIL']}>",
             "to": [email],
             "subject": "Bem-vindo ao Simulador de Crédito Tributário - Conta Azul",
             "html": html_content
         }
 
         response = resend.Emails.send(params)
-        print(f"✅ Email enviado com sucesso para {email} (ID: {response.get('id')})")
+        print(f"✅ Email enviado com sucesso para {email} (ID: {response.get('id')})", file=sys.stderr)
         return True
 
     except Exception as e:
-        print(f"❌ Erro ao enviar email: {str(e)}")
+        print(f"❌ Erro ao enviar email: {str(e)}", file=sys.stderr)
         return False
 
-@app.route('/')
+def buscar_ncm_no_banco(ncm_code, data_referencia):
+    """Busca o NCM direto no banco (usado quando o índice em memória não foi carregado)
+
+    Mesma ordem do NcmIndex.buscar, sempre por chave no índice idx_ncm_vigencia:
+    código exato, faixa de códigos que começam com ele, código com o zero à
+    esquerda restaurado e níveis superiores,
+    considerando só as regras em vigor na data de referência.
+    """
+    vigente = 'vigencia_inicio <= :data AND (vigencia_fim IS NULL OR vigencia_fim > :data)'
+    data = data_referencia.isoformat()
+    conn = get_db_connection()
+
+    try:
+        # Busca exata por NCM
+        result = conn.execute(
+            text(f'SELECT * FROM ncm WHERE ncm = :ncm AND {vigente} ORDER BY id LIMIT 1'),
+            {'ncm': ncm_code, 'data': data}
+        ).fetchone()
+
+        # Se não encontrar, busca por NCM que começa com o código informado
+        # (as chaves só têm dígitos, então ':' é o primeiro caractere depois do prefixo)
+        if not result:
+            result = conn.execute(
+                text(f'SELECT * FROM ncm WHERE ncm >= :inicio AND ncm < :fim AND {vigente} ORDER BY ncm, id LIMIT 1'),
+                {'inicio': ncm_code, 'fim': f'{ncm_code}:', 'data': data}
+            ).fetchone()
+
+        # Código da planilha sem o zero à esquerda ("711" -> posição 0711)
+        if not result and com_zero_a_esquerda(ncm_code) != ncm_code:
+            result = conn.execute(
+                text(f'SELECT * FROM ncm WHERE ncm = :ncm AND {vigente} ORDER BY id LIMIT 1'),
+                {'ncm': com_zero_a_esquerda(ncm_code), 'data': data}
+            ).fetchone()
+
+        # Por fim, a regra do nível superior mais específico
+        if not result and ancestrais(ncm_code):
+            result = conn.execute(
+                text(f'SELECT * FROM ncm WHERE ncm IN :codigos AND {vigente} ORDER BY LENGTH(ncm) DESC, id LIMIT 1')
+                .bindparams(bindparam('codigos', expanding=True)),
+                {'codigos': ancestrais(ncm_code), 'data': data}
+            ).fetchone()
+    finally:
+        conn.close()
+
+    return row_to_dict(result)
+
+@bp.route('/')
 def index():
     """Página principal"""
     # Não limpa a sessão se o usuário já estiver autenticado
@@ -143,7 +527,7 @@ def index():
         session.clear()
     return render_template('index.html')
 
-@app.route('/consultar', methods=['POST'])
+@bp.route('/consultar', methods=['POST'])
 def consultar():
     """Endpoint para consultar NCM"""
     data = request.get_json()
@@ -152,25 +536,31 @@ def consultar():
     if not ncm_code:
         return jsonify({'error': 'Código NCM é obrigatório'}), 400
 
-    conn = get_db_connection()
-
-    # Busca exata por NCM
-    result = conn.execute(
-        text('SELECT * FROM ncm WHERE ncm = :ncm'),
-        {'ncm': ncm_code}
-    ).fetchone()
+    # Só dígitos, como as chaves do import: "1006.30.00" -> "10063000"
+    ncm_code = normalizar_ncm(ncm_code)
 
-    # Se não encontrar, busca por NCM que começa com o código informado
-    if not result:
-        result = conn.execute(
-            text('SELECT * FROM ncm WHERE ncm LIKE :pattern'),
-            {'pattern': f'{ncm_code}%'}
-        ).fetchone()
+    # Classifica pelas regras em vigor na data de referência (ex: emissão da nota)
+    try:
+        data_referencia = parse_data_referencia(data.get('data_referencia'))
+    except ValueError:
+        return jsonify({'error': 'Data de referência inválida (use AAAA-MM-DD)'}), 400
+
+    indice = get_ncm_index()
+    if indice is not None:
+        # Busca no índice em memória carregado no warm-up
+        result_dict = indice.buscar(ncm_code, data_referencia)
+        versao = indice.versao
+    elif ncm_code:
+        result_dict = buscar_ncm_no_banco(ncm_code, data_referencia)
+        versao = None
+    else:
+        result_dict, versao = None, None
 
-    conn.close()
+    registrar_evento('consulta_ncm', ncm_code)
+    if result_dict:
+        registrar_evento('consulta_cclasstrib', result_dict['cclasstrib'])
+        registrar_etapa_funil('consulta')
 
-    if result:
-        result_dict = row_to_dict(result)
         # Salva dados do NCM na sessão
         session['ncm_data'] = {
             'ncm': result_dict['ncm'],
@@ -179,19 +569,21 @@ def consultar():
             'cst': result_dict['cst'],
             'descricao_cst': result_dict['descricao_cst']
         }
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'dataset_version': versao})
     else:
+        registrar_evento('consulta_sem_resultado', ncm_code)
         return jsonify({
             'success': False,
-            'error': 'NCM não encontrado'
+            'error': 'NCM não encontrado',
+            'dataset_version': versao
         }), 404
 
-@app.route('/lead')
+@bp.route('/lead')
 def lead():
     """Página de captura de lead"""
     # Verifica se há dados do NCM na sessão
     if 'ncm_data' not in session:
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     # Se usuário já está autenticado, busca seus dados e vai direto para resultado
     if session.get('user_authenticated'):
@@ -212,13 +604,15 @@ def lead():
                     'telefone': user_dict['telefone'],
                     'cnpj': user_dict['cnpj']
                 }
-                return redirect(url_for('resultado'))
+                # Usuário já cadastrado passa pela etapa de lead sem preencher o formulário
+                registrar_etapa_funil('lead')
+                return redirect(url_for('.resultado'))
         finally:
             conn.close()
 
     return render_template('lead.html')
 
-@app.route('/salvar-lead', methods=['POST'])
+@bp.route('/salvar-lead', methods=['POST'])
 def salvar_lead():
     """Endpoint para salvar lead"""
     data = request.get_json()
@@ -229,6 +623,11 @@ def salvar_lead():
         if not data.get(field):
             return jsonify({'error': f'Campo {field} é obrigatório'}), 400
 
+    if not leads_import.validar_cnpj(data['cnpj']):
+        return jsonify({'error': 'CNPJ inválido'}), 400
+    # Mesmo formato da importação em lote, para a checagem de duplicados pelo idx_cnpj
+    data['cnpj'] = leads_import.formatar_cnpj(data['cnpj'])
+
     # Valida tamanho mínimo da senha
     if len(data.get('senha', '')) < 6:
         return jsonify({'error': 'Senha deve ter no mínimo 6 caracteres'}), 400
@@ -257,6 +656,7 @@ def salvar_lead():
         )
 
         conn.commit()
+        registrar_etapa_funil('lead')
 
         # Autentica o usuário automaticamente após o cadastro
         session.permanent = True  # Torna a sessão permanente (30 dias)
@@ -290,16 +690,16 @@ def salvar_lead():
     finally:
         conn.close()
 
-@app.route('/login')
+@bp.route('/login')
 def login_page():
     """Página de login"""
     # Se já estiver autenticado, redireciona para home
     if session.get('user_authenticated'):
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     return render_template('login.html')
 
-@app.route('/api/login', methods=['POST'])
+@bp.route('/api/login', methods=['POST'])
 def api_login():
     """Endpoint de autenticação"""
     data = request.get_json()
@@ -347,18 +747,18 @@ def api_login():
     finally:
         conn.close()
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Logout do usuário"""
     session.clear()
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
-@app.route('/perfil')
+@bp.route('/perfil')
 def perfil():
     """Página de edição de perfil"""
     # Verifica se o usuário está autenticado
     if not session.get('user_authenticated'):
-        return redirect(url_for('login_page'))
+        return redirect(url_for('.login_page'))
 
     # Busca dados do usuário
     conn = get_db_connection()
@@ -371,7 +771,7 @@ def perfil():
 
         if not user:
             session.clear()
-            return redirect(url_for('login_page'))
+            return redirect(url_for('.login_page'))
 
         user_dict = row_to_dict(user)
         return render_template('perfil.html', user=user_dict)
@@ -379,7 +779,7 @@ def perfil():
     finally:
         conn.close()
 
-@app.route('/api/perfil', methods=['POST'])
+@bp.route('/api/perfil', methods=['POST'])
 def api_perfil():
     """Endpoint para atualizar perfil"""
     # Verifica se o usuário está autenticado
@@ -394,6 +794,10 @@ def api_perfil():
         if not data.get(field):
             return jsonify({'error': f'Campo {field} é obrigatório'}), 400
 
+    if not leads_import.validar_cnpj(data['cnpj']):
+        return jsonify({'error': 'CNPJ inválido'}), 400
+    data['cnpj'] = leads_import.formatar_cnpj(data['cnpj'])
+
     conn = get_db_connection()
 
     try:
@@ -471,23 +875,377 @@ def api_perfil():
     finally:
         conn.close()
 
-@app.route('/resultado')
+def lead_id_da_sessao(conn):
+    """Id do lead autenticado na sessão, ou None"""
+    return conn.execute(
+        text('SELECT id FROM leads WHERE email = :email'),
+        {'email': session.get('user_email')}
+    ).scalar()
+
+@bp.route('/api/catalogo', methods=['POST'])
+def api_catalogo_upload():
+    """Endpoint para cadastrar o catálogo de produtos (CSV com SKU, Descrição e NCM)
+
+    O campo opcional `data_referencia` (AAAA-MM-DD) classifica pelas regras em
+    vigor naquela data (ex: antecipar uma versão futura); sem ele, pelas de hoje.
+    """
+    # Verifica se o usuário está autenticado
+    if not session.get('user_authenticated'):
+        return jsonify({'error': 'Não autenticado'}), 401
+
+    arquivo = request.files.get('arquivo')
+    if arquivo is None:
+        return jsonify({'error': 'Arquivo CSV é obrigatório'}), 400
+
+    try:
+        data_referencia = parse_data_referencia(request.form.get('data_referencia'))
+    except ValueError:
+        return jsonify({'error': 'Data de referência inválida (use AAAA-MM-DD)'}), 400
+
+    indice = get_ncm_index()
+    if indice is None:
+        return jsonify({'error': 'Tabela NCM ainda não carregada, tente novamente'}), 503
+
+    conn = get_db_connection()
+
+    try:
+        lead_id = lead_id_da_sessao(conn)
+        if lead_id is None:
+            return jsonify({'error': 'Usuário não encontrado'}), 404
+
+        # Lê o CSV em streaming e grava em lotes, sem carregar o arquivo todo
+        stream = io.TextIOWrapper(arquivo.stream, encoding='utf-8-sig', newline='')
+        total, sem_regra = salvar_catalogo(conn, lead_id, ler_catalogo_csv(stream), indice, data_referencia)
+        conn.commit()
+
+        return jsonify({
+            'success': True,
+            'skus': total,
+            'sem_regra': sem_regra,
+            'data_referencia': data_referencia.isoformat(),
+            'dataset_version': indice.versao
+        })
+
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
+
+@bp.route('/api/catalogo')
+def api_catalogo():
+    """Endpoint para listar o catálogo classificado (paginado por id: ?apos=<id>&limite=<n>)"""
+    # Verifica se o usuário está autenticado
+    if not session.get('user_authenticated'):
+        return jsonify({'error': 'Não autenticado'}), 401
+
+    apos = request.args.get('apos', 0, type=int)
+    limite = request.args.get('limite', type=int)
+    if 'limite' in request.args and (limite is None or limite < 1):
+        return jsonify({'error': 'Limite deve ser um inteiro maior que zero'}), 400
+    limite = min(limite or 500, 5000)
+    indice = get_ncm_index()
+
+    conn = get_db_connection()
+
+    try:
+        lead_id = lead_id_da_sessao(conn)
+        if lead_id is None:
+            return jsonify({'error': 'Usuário não encontrado'}), 404
+
+        # SKUs classificados por uma versão de regras que já terminou
+        if indice is not None and reclassificar_vencidos(conn, lead_id, indice):
+            conn.commit()
+
+        rows = conn.execute(
+            text('''
+                SELECT id, sku, descricao, ncm, ncm_regra, cclasstrib, cst, descricao_cst,
+                       dataset_versao, classificado_em
+                FROM catalogo
+                WHERE lead_id = :lead_id AND id > :apos
+                ORDER BY id
+                LIMIT :limite
+            '''),
+            {'lead_id': lead_id, 'apos': apos, 'limite': limite}
+        ).fetchall()
+
+        itens = [row_to_dict(row) for row in rows]
+        return jsonify({
+            'itens': itens,
+            'proximo': itens[-1]['id'] if len(itens) == limite else None
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
+
+@bp.route('/admin/leads/export')
+@admin_required
+def admin_leads_export():
+    """Exporta os leads em streaming (?formato=csv|ndjson&cursor=<cursor>&limite=<n>)
+
+    O header X-Next-Cursor traz o cursor a ser enviado na próxima
+    sincronização para receber só os leads novos.
+    """
+    formato = request.args.get('formato', 'csv')
+    if formato not in leads_export.FORMATOS:
+        return jsonify({'error': 'Formato deve ser csv ou ndjson'}), 400
+
+    limite = request.args.get('limite', type=int)
+    if 'limite' in request.args and (limite is None or limite < 1):
+        return jsonify({'error': 'Limite deve ser um inteiro maior que zero'}), 400
+
+    try:
+        apos_id = leads_export.decodificar_cursor(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    conn = get_db_connection()
+    try:
+        ultimo = leads_export.limite_exportacao(conn, apos_id, limite)
+    finally:
+        conn.close()
+
+    ate_id = ultimo[0] if ultimo else apos_id
+    proximo_cursor = leads_export.codificar_cursor(*ultimo) if ultimo else request.args.get('cursor', '')
+
+    def gerar():
+        conn = get_db_connection()
+        try:
+            yield from leads_export.exportar(conn, formato, apos_id, ate_id)
+        finally:
+            conn.close()
+
+    mimetype = 'text/csv' if formato == 'csv' else 'application/x-ndjson'
+    return Response(
+        stream_with_context(gerar()),
+        mimetype=mimetype,
+        headers={
+            'X-Next-Cursor': proximo_cursor,
+            'Content-Disposition': f'attachment; filename=leads.{formato}'
+        }
+    )
+
+@bp.cli.command('gerar-snapshot')
+@click.option('--saida', type=click.Path(dir_okay=False), default=None,
+              help='Caminho do snapshot (padrão: NCM_SNAPSHOT_PATH)')
+def gerar_snapshot_command(saida):
+    """Gera o ncm.snapshot a partir da versão atual do banco (passo de build/deploy)"""
+    path = saida or current_app.config['NCM_SNAPSHOT_PATH']
+    if not path:
+        raise click.UsageError('NCM_SNAPSHOT_PATH vazio: informe --saida')
+
+    conn = get_db_connection()
+    try:
+        indice = NcmIndex.from_connection(conn)
+    finally:
+        conn.close()
+
+    indice.write_snapshot(path)
+    click.echo(f"📦 Snapshot da versão {indice.versao} gravado em {path} "
+               f"({os.path.getsize(path) // 1024} KB)", err=True)
+
+@bp.cli.command('export-leads')
+@click.option('--formato', type=click.Choice(leads_export.FORMATOS), default='csv')
+@click.option('--cursor', default=None, help='Cursor da última sincronização')
+@click.option('--cursor-file', type=click.Path(dir_okay=False), default=None,
+              help='Arquivo que guarda o cursor entre execuções (lido no início, atualizado no fim)')
+@click.option('--limite', type=click.IntRange(min=1), default=None, help='Máximo de leads nesta execução')
+@click.option('--saida', type=click.File('w', encoding='utf-8'), default='-', help='Arquivo de saída (padrão: stdout)')
+def export_leads_command(formato, cursor, cursor_file, limite, saida):
+    """Exporta os leads novos desde o último cursor, em streaming"""
+    if cursor is None and cursor_file and os.path.exists(cursor_file):
+        with open(cursor_file) as arquivo:
+            cursor = arquivo.read().strip() or None
+
+    try:
+        apos_id = leads_export.decodificar_cursor(cursor)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="'--cursor'")
+    conn = get_db_connection()
+
+    try:
+        ultimo = leads_export.limite_exportacao(conn, apos_id, limite)
+        ate_id = ultimo[0] if ultimo else apos_id
+        for linha in leads_export.exportar(conn, formato, apos_id, ate_id):
+            saida.write(linha)
+        saida.flush()
+    finally:
+        conn.close()
+
+    if ultimo is None:
+        click.echo("ℹ️  Nenhum lead novo desde o último cursor", err=True)
+        return
+
+    proximo_cursor = leads_export.codificar_cursor(*ultimo)
+    if cursor_file:
+        # Só avança o cursor depois que todas as linhas foram escritas
+        with open(cursor_file, 'w') as arquivo:
+            arquivo.write(proximo_cursor)
+    click.echo(f"✅ Leads exportados até o id {ultimo[0]}. Próximo cursor: {proximo_cursor}", err=True)
+
+@bp.route('/admin/leads/import', methods=['POST'])
+@admin_required
+def admin_leads_import():
+    """Importa leads de um CSV (Nome, E-mail, Telefone, CNPJ, NCM) em blocos
+
+    Os emails de boas-vindas entram na fila e são enviados pelo comando
+    processar-emails.
+    """
+    arquivo = request.files.get('arquivo')
+    if arquivo is None:
+        return jsonify({'error': 'Arquivo CSV é obrigatório'}), 400
+
+    conn = get_db_connection()
+
+    try:
+        # Lê o CSV em streaming, sem carregar o arquivo todo
+        stream = io.TextIOWrapper(arquivo.stream, encoding='utf-8-sig', newline='')
+        resumo = leads_import.importar_leads(conn, leads_import.ler_leads_csv(stream))
+        return jsonify(dict(resumo, success=True))
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
+
+@bp.cli.command('importar-leads')
+@click.argument('arquivo', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--bloco', type=int, default=leads_import.BATCH_SIZE, help='Linhas por transação')
+def importar_leads_command(arquivo, bloco):
+    """Importa leads de um CSV de parceiro e enfileira os emails de boas-vindas"""
+    conn = get_db_connection()
+
+    try:
+        resumo = leads_import.importar_leads(conn, leads_import.ler_leads_csv(arquivo), bloco)
+    finally:
+        conn.close()
+
+    for rejeitada in resumo['rejeitadas']:
+        click.echo(f"⚠️  Linha {rejeitada['linha']}: {rejeitada['motivo']}", err=True)
+    click.echo(f"✅ {resumo['importados']} leads importados, {resumo['invalidos']} inválidos, "
+               f"{resumo['duplicados']} duplicados", err=True)
+
+def processar_fila_emails(limite=None, lote=100):
+    """Envia os emails de boas-vindas pendentes dos leads importados
+
+    Para cada lead, gera a senha, grava o hash e envia o email; a senha só
+    é confirmada no banco se o envio der certo. Retorna (enviados, falhas).
+    """
+    indice = get_ncm_index()
+    enviados = falhas = 0
+    ultimo_id = 0
+    conn = get_db_connection()
+
+    try:
+        while limite is None or enviados + falhas < limite:
+            tamanho = lote if limite is None else min(lote, limite - enviados - falhas)
+            pendentes = leads_import.emails_pendentes(conn, tamanho, ultimo_id)
+            if not pendentes:
+                break
+
+            for item in pendentes:
+                ultimo_id = item['id']
+                senha = secrets.token_urlsafe(9)
+                if not leads_import.definir_senha(conn, item['lead_id'], generate_password_hash(senha)):
+                    # Lead já tem senha (email enviado por outro processo)
+                    leads_import.marcar_email(conn, item['id'], 'ignorado')
+                    conn.commit()
+                    continue
+
+                regra = indice.buscar(item['ncm']) if indice is not None and item['ncm'] else None
+                ncm_data = regra or ({'ncm': item['ncm']} if item['ncm'] else {})
+                if send_welcome_email(item['email'], item['nome'], senha, ncm_data):
+                    leads_import.marcar_email(conn, item['id'], 'enviado')
+                    conn.commit()
+                    enviados += 1
+                else:
+                    # Descarta a senha gerada; a próxima tentativa gera outra
+                    conn.rollback()
+                    leads_import.marcar_email(conn, item['id'], 'falha', 'Falha no envio')
+                    conn.commit()
+                    falhas += 1
+    finally:
+        conn.close()
+
+    return enviados, falhas
+
+@bp.cli.command('processar-emails')
+@click.option('--limite', type=int, default=None, help='Máximo de emails nesta execução')
+def processar_emails_command(limite):
+    """Envia os emails de boas-vindas da fila dos leads importados"""
+    enviados, falhas = processar_fila_emails(limite)
+    click.echo(f"✅ {enviados} emails enviados, {falhas} falhas", err=True)
+
+@bp.route('/admin/analytics')
+@admin_required
+def admin_analytics():
+    """NCMs e cClassTribs mais consultados e conversão do funil (?dias=30&top=10)"""
+    dias = request.args.get('dias', 30, type=int)
+    top = request.args.get('top', 10, type=int)
+    desde = date.today() - timedelta(days=max(dias, 1) - 1)
+
+    # Grava o que este processo ainda tem em memória antes de consultar
+    buffer = _state()['analytics']
+    if buffer is not None:
+        buffer.flush()
+
+    conn = get_db_connection()
+    try:
+        return jsonify({
+            'desde': desde.isoformat(),
+            'ncms': analytics.top_chaves(conn, 'consulta_ncm', desde, top),
+            'cclasstribs': analytics.top_chaves(conn, 'consulta_cclasstrib', desde, top),
+            'sem_resultado': analytics.top_chaves(conn, 'consulta_sem_resultado', desde, top),
+            'funil': analytics.funil(conn, desde),
+            'descartados': buffer.descartados if buffer is not None else 0
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
+
+@bp.route('/resultado')
 def resultado():
     """Página de resultado com dados do NCM"""
     # Verifica se há dados necessários na sessão
     if 'ncm_data' not in session or 'lead_data' not in session:
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
+    registrar_etapa_funil('resultado')
     return render_template('resultado.html', ncm_data=session['ncm_data'])
 
-@app.route('/simulacao')
+@bp.route('/simulacao')
 def simulacao():
     """Página de simulação de imposto líquido"""
     # Verifica se há dados necessários na sessão
     if 'ncm_data' not in session or 'lead_data' not in session:
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
+    registrar_etapa_funil('simulacao')
     return render_template('simulacao.html')
 
+@bp.route('/healthz')
+def healthz():
+    """Readiness: só responde 200 depois do warm-up"""
+    state = _state()
+    status = 200 if state['ready'] else 503
+    return jsonify({
+        'ready': state['ready'],
+        'import_ms': IMPORT_TIME_MS,
+        'warmup_ms': state['warmup_ms'],
+        'dataset': {
+            'versao': state['ncm_index'].versao,
+            'checksum': state['ncm_index'].checksum,
+            'origem': state['ncm_index'].origem,
+            'registros': len(state['ncm_index'])
+        } if state['ncm_index'] is not None else None,
+        'memoria': uso_memoria()
+    }), status
+
+# Tempo de import deste módulo (ver check_import_time.py)
+IMPORT_TIME_MS = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    create_app().run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1,217 @@
+"""Catálogo de produtos (SKUs) das empresas e sua classificação
+
+Cada lead pode cadastrar o catálogo completo (SKU, descrição, NCM) uma
+única vez. O resultado da classificação fica gravado junto de cada SKU e é
+atualizado só quando as regras que o afetam mudam:
+
+- no import_csv.py, os códigos cujas regras mudaram são comparados com o
+  catálogo pelo índice idx_catalogo_ncm, que funciona como índice reverso
+  prefixo → SKU (faixa de códigos que começam com o prefixo alterado e
+  códigos que são prefixo dele);
+- ao importar uma versão futura, a classificação de todos os SKUs passa a
+  vencer no início dela (vigente_ate);
+- SKUs classificados por uma versão que já terminou (vigente_ate no
+  passado) são reclassificados quando o catálogo é lido.
+"""
+import csv
+from datetime import date
+
+from sqlalchemy import bindparam, text
+
+from normalizacao import normalizar_ncm
+
+# Quantidade de SKUs por INSERT/UPDATE em lote
+BATCH_SIZE = 500
+
+# Colunas aceitas no CSV do catálogo (cabeçalho em minúsculas)
+_COLUNAS_CSV = {
+    'sku': 'sku',
+    'codigo': 'sku',
+    'descricao': 'descricao',
+    'descrição': 'descricao',
+    'ncm': 'ncm',
+}
+
+_SQL_UPSERT = text('''
+    INSERT INTO catalogo (lead_id, sku, descricao, ncm, ncm_regra, cclasstrib, cst, descricao_cst,
+                          dataset_versao, vigente_ate, classificado_em)
+    VALUES (:lead_id, :sku, :descricao, :ncm, :ncm_regra, :cclasstrib, :cst, :descricao_cst,
+            :dataset_versao, :vigente_ate, CURRENT_TIMESTAMP)
+    ON CONFLICT (lead_id, sku) DO UPDATE SET
+        descricao = excluded.descricao,
+        ncm = excluded.ncm,
+        ncm_regra = excluded.ncm_regra,
+        cclasstrib = excluded.cclasstrib,
+        cst = excluded.cst,
+        descricao_cst = excluded.descricao_cst,
+        dataset_versao = excluded.dataset_versao,
+        vigente_ate = excluded.vigente_ate,
+        classificado_em = excluded.classificado_em
+''')
+
+_SQL_RECLASSIFICAR = text('''
+    UPDATE catalogo
+    SET ncm_regra = :ncm_regra, cclasstrib = :cclasstrib, cst = :cst, descricao_cst = :descricao_cst,
+        dataset_versao = :dataset_versao, vigente_ate = :vigente_ate, classificado_em = CURRENT_TIMESTAMP
+    WHERE ncm = :ncm
+''')
+
+
+def ler_catalogo_csv(arquivo):
+    """Lê os SKUs de um CSV (colunas SKU, Descrição e NCM) sem carregar o arquivo todo
+
+    `arquivo` é um arquivo de texto aberto. Linhas sem SKU ou NCM são ignoradas.
+    """
+    leitor = csv.DictReader(arquivo)
+    for row in leitor:
+        item = {}
+        for coluna, valor in row.items():
+            campo = _COLUNAS_CSV.get((coluna or '').strip().lower())
+            if campo:
+                item[campo] = (valor or '').strip()
+        item['ncm'] = normalizar_ncm(item.get('ncm'))
+        if item.get('sku') and item['ncm']:
+            item.setdefault('descricao', '')
+            yield item
+
+
+def em_lotes(itens, tamanho=BATCH_SIZE):
+    """Agrupa um iterável em listas de até `tamanho` itens"""
+    lote = []
+    for item in itens:
+        lote.append(item)
+        if len(lote) == tamanho:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+class Classificador:
+    """Classifica NCMs pelas regras em vigor em uma data, uma única vez por NCM"""
+
+    def __init__(self, indice, data=None):
+        self.indice = indice
+        self.data = data or date.today()
+        # A classificação vale até o início da próxima versão das regras
+        self.vigente_ate = indice.proxima_vigencia(self.data)
+        self._cache = {}
+
+    def __call__(self, ncm):
+        """Campos de classificação gravados junto do SKU"""
+        if ncm not in self._cache:
+            regra = self.indice.buscar(ncm, self.data)
+            self._cache[ncm] = {
+                'ncm_regra': regra['ncm'] if regra else None,
+                'cclasstrib': regra['cclasstrib'] if regra else None,
+                'cst': regra['cst'] if regra else None,
+                'descricao_cst': regra['descricao_cst'] if regra else None,
+                'dataset_versao': self.indice.versao,
+                'vigente_ate': self.vigente_ate,
+            }
+        return self._cache[ncm]
+
+
+def salvar_catalogo(conn, lead_id, itens, indice, data=None):
+    """Classifica e grava os SKUs do lead em lotes (SKU já existente é atualizado)
+
+    Retorna (total de SKUs gravados, total sem regra encontrada).
+    """
+    classificar = Classificador(indice, data)
+    total = sem_regra = 0
+
+    for lote in em_lotes(itens):
+        for item in lote:
+            item.update(classificar(item['ncm']), lead_id=lead_id)
+            sem_regra += item['cclasstrib'] is None
+        conn.execute(_SQL_UPSERT, lote)
+        total += len(lote)
+
+    return total, sem_regra
+
+
+def _reclassificar_ncms(conn, ncms, indice, data):
+    """Atualiza a classificação de todos os SKUs com os NCMs informados"""
+    classificar = Classificador(indice, data)
+    parametros = [dict(classificar(ncm), ncm=ncm) for ncm in ncms]
+    for lote in em_lotes(parametros):
+        conn.execute(_SQL_RECLASSIFICAR, lote)
+
+
+def ncms_afetados(conn, codigos_alterados):
+    """NCMs do catálogo cuja classificação pode mudar com os códigos alterados
+
+    Um SKU é afetado se o seu NCM começa com um código alterado (a regra de
+    um nível superior mudou) ou se o seu NCM é prefixo de um código alterado
+    (a busca por prefixo pode passar a achar outra regra). As duas consultas
+    usam o idx_catalogo_ncm: uma faixa por código e um IN com os prefixos.
+    """
+    # Códigos dentro da faixa de outro código alterado já são cobertos por ela
+    codigos = []
+    for codigo in sorted(codigos_alterados):
+        if codigo and not (codigos and codigo.startswith(codigos[-1])):
+            codigos.append(codigo)
+
+    afetados = set()
+    for codigo in codigos:
+        rows = conn.execute(
+            text('SELECT DISTINCT ncm FROM catalogo WHERE ncm >= :inicio AND ncm < :fim'),
+            {'inicio': codigo, 'fim': f'{codigo}:'}
+        )
+        afetados.update(row[0] for row in rows)
+
+    prefixos = sorted({codigo[:tamanho] for codigo in codigos for tamanho in range(1, len(codigo))})
+    for lote in em_lotes(prefixos):
+        rows = conn.execute(
+            text('SELECT DISTINCT ncm FROM catalogo WHERE ncm IN :prefixos')
+            .bindparams(bindparam('prefixos', expanding=True)),
+            {'prefixos': lote}
+        )
+        afetados.update(row[0] for row in rows)
+
+    return afetados
+
+
+def reclassificar_alterados(conn, indice_anterior, indice_novo, data=None):
+    """Reclassifica só os SKUs afetados pela troca de regras de `indice_anterior` para `indice_novo`
+
+    Retorna (códigos de regra alterados, NCMs do catálogo reclassificados).
+    """
+    data = data or date.today()
+    anteriores = indice_anterior.regras_vigentes(data) if indice_anterior is not None else {}
+    novas = indice_novo.regras_vigentes(data)
+    alterados = {codigo for codigo in anteriores.keys() | novas.keys()
+                 if anteriores.get(codigo) != novas.get(codigo)}
+
+    ncms = ncms_afetados(conn, alterados) if alterados else set()
+    _reclassificar_ncms(conn, ncms, indice_novo, data)
+    return alterados, ncms
+
+
+def limitar_vigencia(conn, inicio, data=None):
+    """Faz as classificações que passariam de `inicio` vencerem nessa data
+
+    Chamada ao importar uma versão futura das regras: as classificações
+    feitas pelas regras de hoje deixam de valer quando a nova versão começa
+    e são refeitas por reclassificar_vencidos a partir dessa data. Retorna
+    o total de SKUs afetados.
+    """
+    data = data or date.today()
+    if inicio <= data.isoformat():
+        return 0
+    return conn.execute(
+        text('UPDATE catalogo SET vigente_ate = :inicio WHERE vigente_ate IS NULL OR vigente_ate > :inicio'),
+        {'inicio': inicio}
+    ).rowcount
+
+
+def reclassificar_vencidos(conn, lead_id, indice, data=None):
+    """Reclassifica os SKUs do lead classificados por uma versão de regras que já terminou"""
+    data = data or date.today()
+    rows = conn.execute(
+        text('SELECT DISTINCT ncm FROM catalogo WHERE lead_id = :lead_id AND vigente_ate <= :data'),
+        {'lead_id': lead_id, 'data': data.isoformat()}
+    )
+    ncms = [row[0] for row in rows]
+    _reclassificar_ncms(conn, ncms, indice, data)
+    return len(ncms)
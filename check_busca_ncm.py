@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Confere a busca de NCMs digitados contra a planilha e falha se algum não resolver
+
+Uso: python check_busca_ncm.py [csv_file]
+
+Monta o índice em memória direto do CSV (sem banco) e busca códigos
+completos, parciais (prefixo) e os da planilha que perderam o zero à
+esquerda, como um usuário os digitaria no /consultar.
+"""
+
+import sys
+
+from import_csv import CSV_FILE, ler_csv
+from ncm_index import NcmIndex
+
+# Código digitado -> prefixo esperado da chave NCM da regra encontrada
+CASOS = {
+    '1006.30.00': '100630',  # código completo, regra do nível superior
+    '711': '0711',           # posição da planilha sem o zero à esquerda
+    '7': '07',               # capítulo da planilha sem o zero à esquerda
+    '851': '851',            # código parcial (prefixo)
+    '220': '220',
+    '100': '100',
+    '8': '8',
+}
+
+def main():
+    csv_file = sys.argv[1] if len(sys.argv) > 1 else CSV_FILE
+    indice = NcmIndex(ler_csv(csv_file))
+
+    falhas = 0
+    for digitado, esperado in CASOS.items():
+        regra = indice.buscar(digitado)
+        encontrado = regra['ncm'] if regra else None
+        if encontrado is None or not encontrado.startswith(esperado):
+            print(f"❌ {digitado!r}: esperado {esperado}…, encontrado {encontrado}")
+            falhas += 1
+        else:
+            print(f"✅ {digitado!r} -> {encontrado} (cClassTrib {regra['cclasstrib']})")
+
+    return 1 if falhas else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Mede o tempo de import do app.py e falha se passar do orçamento
+
+Uso: python check_import_time.py [--budget-ms 800] [--runs 5]
+
+Cada medição roda em um processo novo (cold start), como em uma instância
+serverless ou recém-criada pelo autoscaling.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Orçamento padrão para o `import app` (ms), sobrescrito por IMPORT_BUDGET_MS.
+# Flask e SQLAlchemy sozinhos levam ~500 ms em cold start; a folga pega
+# regressões como uma dependência pesada importada no topo de um módulo.
+DEFAULT_BUDGET_MS = 800
+
+MEASURE_SNIPPET = (
+    "import time; t = time.perf_counter(); import app; "
+    "print((time.perf_counter() - t) * 1000)"
+)
+
+def measure_import_ms():
+    """Mede o import do app.py em um interpretador novo"""
+    output = subprocess.check_output(
+        [sys.executable, '-c', MEASURE_SNIPPET],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        text=True
+    )
+    return float(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float,
+                        default=float(os.getenv('IMPORT_BUDGET_MS', DEFAULT_BUDGET_MS)))
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    samples = [measure_import_ms() for _ in range(args.runs)]
+    median = statistics.median(samples)
+
+    print(f"⏱️  import app: mediana {median:.1f} ms "
+          f"(min {min(samples):.1f}, max {max(samples):.1f}, {args.runs} execuções)")
+
+    if median > args.budget_ms:
+        print(f"❌ Acima do orçamento de {args.budget_ms:.0f} ms")
+        return 1
+
+    print(f"✅ Dentro do orçamento de {args.budget_ms:.0f} ms")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""Criação da engine SQLAlchemy para o Turso Database"""
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+
+def build_engine(turso_database_url=None, turso_auth_token=None, database_url=None, echo=False,
+                 poolclass=StaticPool):
+    """Cria engine do SQLAlchemy com Turso
+
+    Se `database_url` for informado (ex: sqlite:///local.db), ele é usado
+    diretamente, o que permite rodar a aplicação contra um SQLite local.
+    Retorna None quando nenhuma credencial foi configurada.
+
+    O StaticPool padrão entrega a mesma conexão a todas as threads; código
+    que roda em outra thread e faz commit por conta própria deve usar uma
+    engine separada (ex: poolclass=NullPool).
+    """
+    if database_url:
+        return create_engine(
+            database_url,
+            connect_args={'check_same_thread': False},
+            poolclass=poolclass,
+            echo=echo
+        )
+
+    if not turso_database_url or not turso_auth_token:
+        return None
+
+    # Remove o protocolo libsql:// se estiver presente
+    url_without_protocol = turso_database_url.replace('libsql://', '')
+    db_url = f"sqlite+libsql://{url_without_protocol}?secure=true"
+
+    return create_engine(
+        db_url,
+        connect_args={
+            'check_same_thread': False,
+            'auth_token': turso_auth_token
+        },
+        poolclass=poolclass,
+        echo=echo
+    )
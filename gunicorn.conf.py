@@ -0,0 +1,32 @@
+"""Configuração do gunicorn para o modo prefork
+
+Uso: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import multiprocessing
+import os
+
+from app import flush_analytics, iniciar_analytics, install_reload_signal
+from memoria import uso_memoria
+
+bind = os.getenv('BIND', '0.0.0.0:5001')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+# Carrega a aplicação (e os NCMs) no master, antes do fork
+preload_app = True
+
+
+def when_ready(server):
+    server.log.info("Master pronto: %s", uso_memoria())
+
+
+def post_worker_init(worker):
+    # O worker restaura os sinais padrão ao iniciar; reinstala o SIGUSR2 de recarga do dataset
+    install_reload_signal(worker.wsgi)
+    # Thread de flush de analytics iniciada antes da primeira requisição
+    iniciar_analytics(worker.wsgi)
+    worker.log.info("Worker %s iniciado: %s", worker.pid, uso_memoria())
+
+
+def worker_exit(server, worker):
+    # Encerramento gracioso: grava os contadores de analytics ainda em memória
+    flush_analytics(worker.wsgi)
@@ -1,33 +1,30 @@
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import StaticPool
+from sqlalchemy import text
+from datetime import date
+import argparse
 import csv
 import os
 from dotenv import load_dotenv
 
+from catalogo import limitar_vigencia, reclassificar_alterados
+from db import build_engine
+from ncm_index import (SNAPSHOT_PATH_PADRAO, VIGENCIA_INICIAL, NcmIndex,
+                       checksum_registros, ler_registros, migrar_vigencias)
+from normalizacao import expandir_celula
+
 # Carrega variáveis de ambiente
 load_dotenv()
 
 def get_engine():
     """Cria engine do SQLAlchemy com Turso"""
-    TURSO_DATABASE_URL = os.getenv('TURSO_DATABASE_URL')
-    TURSO_AUTH_TOKEN = os.getenv('TURSO_AUTH_TOKEN')
+    engine = build_engine(
+        turso_database_url=os.getenv('TURSO_DATABASE_URL'),
+        turso_auth_token=os.getenv('TURSO_AUTH_TOKEN'),
+        database_url=os.getenv('DATABASE_URL')
+    )
 
-    if not TURSO_DATABASE_URL or not TURSO_AUTH_TOKEN:
+    if engine is None:
         raise Exception("⚠️  Configure TURSO_DATABASE_URL e TURSO_AUTH_TOKEN no arquivo .env")
 
-    # Remove o protocolo libsql:// se estiver presente
-    url_without_protocol = TURSO_DATABASE_URL.replace('libsql://', '')
-    db_url = f"sqlite+libsql://{url_without_protocol}?secure=true"
-
-    engine = create_engine(
-        db_url,
-        connect_args={
-            'check_same_thread': False,
-            'auth_token': TURSO_AUTH_TOKEN
-        },
-        poolclass=StaticPool,
-        echo=False
-    )
     return engine
 
 def create_database():
@@ -44,10 +41,15 @@ def create_database():
                 descricao TEXT,
                 cclasstrib TEXT,
                 cst TEXT,
-                descricao_cst TEXT
+                descricao_cst TEXT,
+                vigencia_inicio TEXT NOT NULL DEFAULT '0001-01-01',
+                vigencia_fim TEXT
             )
         '''))
 
+        # Bancos criados antes das vigências: acrescenta as colunas
+        migrar_vigencias(conn)
+
         # Cria tabela de leads
         conn.execute(text('''
             CREATE TABLE IF NOT EXISTS leads (
@@ -62,12 +64,86 @@ def create_database():
             )
         '''))
 
+        # Cria tabela de versões do dataset (uma linha por importação)
+        conn.execute(text('''
+            CREATE TABLE IF NOT EXISTS dataset_meta (
+                versao INTEGER PRIMARY KEY,
+                linhas INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                vigencia_inicio TEXT,
+                importado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        '''))
+        colunas = {row[1] for row in conn.execute(text('PRAGMA table_info(dataset_meta)'))}
+        if 'vigencia_inicio' not in colunas:
+            conn.execute(text('ALTER TABLE dataset_meta ADD COLUMN vigencia_inicio TEXT'))
+
         # Cria índice para busca rápida por NCM
         conn.execute(text('CREATE INDEX IF NOT EXISTS idx_ncm ON ncm(ncm)'))
 
+        # Cria índice para busca por NCM em uma data de referência
+        conn.execute(text('CREATE INDEX IF NOT EXISTS idx_ncm_vigencia ON ncm(ncm, vigencia_inicio)'))
+
         # Cria índice para busca por CNPJ
         conn.execute(text('CREATE INDEX IF NOT EXISTS idx_cnpj ON leads(cnpj)'))
 
+        # CNPJs gravados sem máscara antes da importação em lote: passa para o formato
+        # 11.222.333/0001-81, o mesmo usado na checagem de duplicados
+        conn.execute(text('''
+            UPDATE leads
+            SET cnpj = substr(cnpj, 1, 2) || '.' || substr(cnpj, 3, 3) || '.' || substr(cnpj, 6, 3)
+                       || '/' || substr(cnpj, 9, 4) || '-' || substr(cnpj, 13, 2)
+            WHERE length(cnpj) = 14 AND cnpj NOT GLOB '*[^0-9]*'
+        '''))
+
+        # Cria tabela do catálogo de produtos dos leads, com a classificação de cada SKU
+        conn.execute(text('''
+            CREATE TABLE IF NOT EXISTS catalogo (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                lead_id INTEGER NOT NULL REFERENCES leads(id) ON DELETE CASCADE,
+                sku TEXT NOT NULL,
+                descricao TEXT,
+                ncm TEXT NOT NULL,
+                ncm_regra TEXT,
+                cclasstrib TEXT,
+                cst TEXT,
+                descricao_cst TEXT,
+                dataset_versao INTEGER,
+                vigente_ate TEXT,
+                classificado_em TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (lead_id, sku)
+            )
+        '''))
+
+        # Índice reverso NCM → SKU, usado na reclassificação incremental
+        conn.execute(text('CREATE INDEX IF NOT EXISTS idx_catalogo_ncm ON catalogo(ncm)'))
+
+        # Cria a fila de emails de boas-vindas dos leads importados em lote
+        conn.execute(text('''
+            CREATE TABLE IF NOT EXISTS email_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                lead_id INTEGER NOT NULL REFERENCES leads(id) ON DELETE CASCADE,
+                status TEXT NOT NULL DEFAULT 'pendente',
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                erro TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                processado_em TIMESTAMP
+            )
+        '''))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS idx_email_queue_status ON email_queue(status, id)'))
+
+        # Cria tabela de contadores de analytics (gravados em lote pelo app)
+        conn.execute(text('''
+            CREATE TABLE IF NOT EXISTS analytics_contadores (
+                dia TEXT NOT NULL,
+                evento TEXT NOT NULL,
+                chave TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dia, evento, chave)
+            )
+        '''))
+
         conn.commit()
         print("✅ Tabelas criadas com sucesso no Turso!")
         return conn
@@ -77,67 +153,147 @@ def create_database():
         conn.close()
         raise
 
-def import_csv_to_db():
-    """Importa os dados do CSV para o banco de dados Turso"""
-    engine = get_engine()
-    conn = create_database()
+CSV_FILE = 'Planilha Exclusíva - NCM_NBS x Cclasstrib - Mercadorias.csv'
 
-    try:
-        # Limpa dados anteriores
-        conn.execute(text('DELETE FROM ncm'))
-        conn.commit()
-        print("🗑️  Dados anteriores removidos")
+def ler_csv(csv_file):
+    """Lê os registros do CSV na ordem do arquivo, já com as chaves NCM normalizadas
+
+    Cada linha gera um registro por chave canônica (ver normalizacao.expandir_celula):
+    células com vários códigos e faixas declaradas na descrição viram chaves explícitas.
+    """
+    registros = []
+    with open(csv_file, 'r', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            for chave in expandir_celula(row['NCM'], row['Descrição']):
+                registros.append({
+                    'ncm': chave,
+                    'descricao': row['Descrição'],
+                    'cclasstrib': row['Cclasstrib'],
+                    'cst': row['CST'],
+                    'descricao_cst': row['Descrição CST-IBS/CBS']
+                })
+    return registros
+
+def import_csv_to_db(csv_file=CSV_FILE, vigencia=VIGENCIA_INICIAL):
+    """Importa os dados do CSV para o banco de dados Turso
 
-        # Lê e importa o CSV
-        csv_file = 'Planilha Exclusíva - NCM_NBS x Cclasstrib - Mercadorias.csv'
+    O CSV é uma versão completa das regras, em vigor a partir de `vigencia`
+    (data ISO). As versões anteriores são mantidas: a que estava em vigor
+    nessa data passa a terminar nela, e a nova vale até o início da próxima
+    versão já importada (se houver). Reimportar com a mesma vigência
+    substitui aquela versão; sem `vigencia`, substitui a versão base.
 
+    A troca dos dados e o registro da nova versão em `dataset_meta` são
+    feitos em uma única transação: a aplicação nunca vê a tabela pela metade
+    e só recarrega o índice quando a versão muda.
+    """
+    conn = create_database()
+
+    try:
+        # Lê o CSV
         if not os.path.exists(csv_file):
             raise FileNotFoundError(f"Arquivo {csv_file} não encontrado")
 
         print(f"📁 Lendo arquivo {csv_file}...")
+        registros = ler_csv(csv_file)
 
-        with open(csv_file, 'r', encoding='utf-8') as file:
-            csv_reader = csv.DictReader(file)
-
-            rows_imported = 0
-            batch_size = 100  # Commit a cada 100 registros
-
-            for row in csv_reader:
-                conn.execute(
-                    text('''
-                        INSERT INTO ncm (ncm, descricao, cclasstrib, cst, descricao_cst)
-                        VALUES (:ncm, :descricao, :cclasstrib, :cst, :descricao_cst)
-                    '''),
-                    {
-                        'ncm': row['NCM'],
-                        'descricao': row['Descrição'],
-                        'cclasstrib': row['Cclasstrib'],
-                        'cst': row['CST'],
-                        'descricao_cst': row['Descrição CST-IBS/CBS']
-                    }
-                )
-                rows_imported += 1
-
-                # Commit em lotes
-                if rows_imported % batch_size == 0:
-                    conn.commit()
-                    print(f"  ⏳ {rows_imported} registros importados...")
-
-        # Commit final
+        # Regras antes do import, para reclassificar só os SKUs afetados
+        registros_anteriores = ler_registros(conn)
+        indice_anterior = NcmIndex(registros_anteriores) if registros_anteriores else None
+
+        # Substitui a versão com a mesma vigência, se já importada
+        removidos = conn.execute(
+            text('DELETE FROM ncm WHERE vigencia_inicio = :vigencia'),
+            {'vigencia': vigencia}
+        ).rowcount
+        if removidos:
+            print(f"🗑️  {removidos} registros da vigência {vigencia} removidos")
+
+        # A nova versão vale até o início da próxima, se houver
+        vigencia_fim = conn.execute(
+            text('SELECT MIN(vigencia_inicio) FROM ncm WHERE vigencia_inicio > :vigencia'),
+            {'vigencia': vigencia}
+        ).scalar()
+
+        # Encerra a versão que estava em vigor na data
+        conn.execute(
+            text('''
+                UPDATE ncm SET vigencia_fim = :vigencia
+                WHERE vigencia_inicio < :vigencia AND (vigencia_fim IS NULL OR vigencia_fim > :vigencia)
+            '''),
+            {'vigencia': vigencia}
+        )
+
+        for registro in registros:
+            registro['vigencia_inicio'] = vigencia
+            registro['vigencia_fim'] = vigencia_fim
+
+        batch_size = 100  # Insere em lotes de 100 registros
+        for inicio in range(0, len(registros), batch_size):
+            conn.execute(
+                text('''
+                    INSERT INTO ncm (ncm, descricao, cclasstrib, cst, descricao_cst, vigencia_inicio, vigencia_fim)
+                    VALUES (:ncm, :descricao, :cclasstrib, :cst, :descricao_cst, :vigencia_inicio, :vigencia_fim)
+                '''),
+                registros[inicio:inicio + batch_size]
+            )
+            print(f"  ⏳ {min(inicio + batch_size, len(registros))} registros importados...")
+
+        # Registra a nova versão do dataset (conteúdo completo da tabela, todas as vigências)
+        todos_registros = ler_registros(conn)
+        versao = conn.execute(
+            text('SELECT COALESCE(MAX(versao), 0) + 1 FROM dataset_meta')
+        ).scalar()
+        checksum = checksum_registros(todos_registros)
+        conn.execute(
+            text('''
+                INSERT INTO dataset_meta (versao, linhas, checksum, vigencia_inicio)
+                VALUES (:versao, :linhas, :checksum, :vigencia)
+            '''),
+            {'versao': versao, 'linhas': len(todos_registros), 'checksum': checksum, 'vigencia': vigencia}
+        )
+
+        # Commit único: dados e versão ficam visíveis juntos
         conn.commit()
 
         # Verifica total de registros
         result = conn.execute(text('SELECT COUNT(*) as count FROM ncm')).fetchone()
         count = result[0]
 
-        print(f"✅ Importação concluída! {count} registros no banco Turso.")
+        print(f"✅ Importação concluída! {len(registros)} registros em vigor a partir de {vigencia}, "
+              f"{count} no total no banco Turso (versão {versao}, checksum {checksum[:12]}).")
+
+        indice = NcmIndex(todos_registros, versao=versao, checksum=checksum)
+
+        # Gera o snapshot compilado que a aplicação carrega com mmap
+        snapshot_path = os.getenv('NCM_SNAPSHOT_PATH', SNAPSHOT_PATH_PADRAO)
+        if snapshot_path:
+            indice.write_snapshot(snapshot_path)
+            print(f"📦 Snapshot compilado gravado em {snapshot_path} ({os.path.getsize(snapshot_path) // 1024} KB)")
+
+        # Reclassifica os SKUs dos catálogos afetados pelas regras alteradas
+        alterados, ncms = reclassificar_alterados(conn, indice_anterior, indice)
+        # Versão futura: as classificações atuais vencem quando ela começar
+        limitados = limitar_vigencia(conn, vigencia)
+        conn.commit()
+        print(f"🔁 {len(alterados)} códigos com regra alterada, "
+              f"{len(ncms)} NCMs do catálogo reclassificados")
+        if limitados:
+            print(f"📅 {limitados} SKUs do catálogo serão reclassificados a partir de {vigencia}")
 
     except Exception as e:
+        conn.rollback()
         print(f"❌ Erro durante importação: {e}")
         raise
     finally:
         conn.close()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Importa a tabela NCM x Cclasstrib para o Turso')
+    parser.add_argument('csv_file', nargs='?', default=CSV_FILE, help='Arquivo CSV da planilha')
+    parser.add_argument('--vigencia', type=date.fromisoformat, default=None,
+                        help='Data (AAAA-MM-DD) a partir da qual esta versão vale; sem ela, substitui a versão base')
+    args = parser.parse_args()
+
     print("🚀 Iniciando importação de dados para Turso Database...")
-    import_csv_to_db()
+    import_csv_to_db(args.csv_file, args.vigencia.isoformat() if args.vigencia else VIGENCIA_INICIAL)
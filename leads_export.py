@@ -0,0 +1,109 @@
+"""Exportação dos leads em streaming (CSV ou NDJSON) para sincronização com o CRM
+
+A leitura é paginada por keyset no `id` (páginas de tamanho fixo com
+`WHERE id > :apos`), então a memória usada não cresce com a tabela. O
+cursor guarda o `id` e o `created_at` do último lead exportado: a próxima
+sincronização parte dele e recebe só os leads novos.
+"""
+import base64
+import csv
+import io
+import json
+
+from sqlalchemy import text
+
+# Colunas exportadas (a senha nunca sai do banco)
+COLUNAS = ('id', 'nome', 'email', 'telefone', 'cnpj', 'ncm', 'created_at')
+
+FORMATOS = ('csv', 'ndjson')
+
+# Leads lidos do banco por página
+PAGE_SIZE = 1000
+
+
+def codificar_cursor(lead_id, created_at):
+    """Cursor opaco (base64 de um JSON) apontando para o último lead exportado"""
+    dados = json.dumps({'id': lead_id, 'created_at': str(created_at) if created_at else None})
+    return base64.urlsafe_b64encode(dados.encode('utf-8')).decode('ascii')
+
+
+def decodificar_cursor(cursor):
+    """Id do último lead exportado a partir do cursor (0 se vazio)
+
+    Levanta ValueError se o cursor for inválido.
+    """
+    if not cursor:
+        return 0
+    try:
+        dados = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return int(dados['id'])
+    except Exception as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+
+
+def limite_exportacao(conn, apos_id, limite=None):
+    """Último lead (id, created_at) que entra nesta exportação, ou None se não há leads novos
+
+    Fixar o limite antes de começar garante que o cursor retornado
+    corresponde exatamente às linhas enviadas, mesmo com cadastros
+    acontecendo durante a exportação. `limite`, se informado, deve ser >= 1.
+    """
+    if limite is not None and limite < 1:
+        raise ValueError(f"Limite inválido: {limite}")
+    if limite:
+        row = conn.execute(
+            text('SELECT id, created_at FROM leads WHERE id > :apos ORDER BY id LIMIT 1 OFFSET :offset'),
+            {'apos': apos_id, 'offset': limite - 1}
+        ).fetchone()
+        if row is not None:
+            return row[0], row[1]
+
+    row = conn.execute(
+        text('SELECT id, created_at FROM leads WHERE id = (SELECT MAX(id) FROM leads) AND id > :apos'),
+        {'apos': apos_id}
+    ).fetchone()
+    return (row[0], row[1]) if row is not None else None
+
+
+def iter_leads(conn, apos_id, ate_id, page_size=PAGE_SIZE):
+    """Leads com apos_id < id <= ate_id, em ordem de id, uma página por vez"""
+    while True:
+        rows = conn.execute(
+            text(f'''
+                SELECT {", ".join(COLUNAS)} FROM leads
+                WHERE id > :apos AND id <= :ate
+                ORDER BY id
+                LIMIT :page_size
+            '''),
+            {'apos': apos_id, 'ate': ate_id, 'page_size': page_size}
+        ).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield dict(row._mapping)
+        apos_id = rows[-1][0]
+
+
+def linhas_csv(leads):
+    """Cabeçalho e uma linha CSV por lead, geradas conforme os leads chegam"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUNAS)
+    writer.writeheader()
+    yield buffer.getvalue()
+    for lead in leads:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(lead)
+        yield buffer.getvalue()
+
+
+def linhas_ndjson(leads):
+    """Um objeto JSON por linha para cada lead"""
+    for lead in leads:
+        yield json.dumps(lead, ensure_ascii=False, default=str) + '\n'
+
+
+def exportar(conn, formato, apos_id, ate_id, page_size=PAGE_SIZE):
+    """Gera o conteúdo da exportação no formato pedido ('csv' ou 'ndjson')"""
+    leads = iter_leads(conn, apos_id, ate_id, page_size)
+    return linhas_csv(leads) if formato == 'csv' else linhas_ndjson(leads)
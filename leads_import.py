@@ -0,0 +1,237 @@
+"""Importação em lote de leads enviados por parceiros (CSV)
+
+O arquivo é lido em streaming e processado em blocos de BATCH_SIZE linhas.
+Para cada bloco: o CNPJ é validado no servidor (dígitos verificadores), as
+linhas repetidas no próprio arquivo ou já cadastradas (mesmo e-mail ou
+CNPJ, consultados pelo índice único de e-mail e pelo idx_cnpj) são
+descartadas e o restante é inserido com um INSERT em lote, em uma
+transação por bloco.
+
+Os leads importados não recebem senha na importação (a senha '!' não
+corresponde a nenhum hash, então o login fica bloqueado). O email de
+boas-vindas entra na fila `email_queue`, processada fora da importação
+pelo comando `flask --app app processar-emails`, que gera a senha e envia
+o email.
+"""
+import csv
+import re
+
+from sqlalchemy import bindparam, text
+
+from catalogo import em_lotes
+from normalizacao import normalizar_ncm
+
+# Linhas por bloco (uma transação por bloco)
+BATCH_SIZE = 1000
+
+# Senha dos leads importados que ainda não receberam o email de boas-vindas
+SENHA_PENDENTE = '!'
+
+# Tentativas de envio antes de o email ficar com status 'erro'
+MAX_TENTATIVAS = 5
+
+# Máximo de linhas rejeitadas detalhadas no resumo da importação
+MAX_REJEITADAS = 100
+
+# Pesos dos dígitos verificadores do CNPJ
+_PESOS_DV1 = (5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+_PESOS_DV2 = (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+
+# Colunas aceitas no CSV (cabeçalho em minúsculas)
+_COLUNAS_CSV = {
+    'nome': 'nome',
+    'razao social': 'nome',
+    'razão social': 'nome',
+    'email': 'email',
+    'e-mail': 'email',
+    'telefone': 'telefone',
+    'cnpj': 'cnpj',
+    'ncm': 'ncm',
+}
+
+_CAMPOS_OBRIGATORIOS = ('nome', 'email', 'telefone', 'cnpj')
+
+_SQL_INSERT = text('''
+    INSERT INTO leads (nome, email, telefone, cnpj, senha, ncm)
+    VALUES (:nome, :email, :telefone, :cnpj, :senha, :ncm)
+''')
+
+_SQL_ENFILEIRAR = text('''
+    INSERT INTO email_queue (lead_id)
+    SELECT id FROM leads WHERE email IN :emails
+''').bindparams(bindparam('emails', expanding=True))
+
+_SQL_EXISTENTES = text('''
+    SELECT email, cnpj FROM leads WHERE email IN :emails
+    UNION ALL
+    SELECT email, cnpj FROM leads WHERE cnpj IN :cnpjs
+''').bindparams(bindparam('emails', expanding=True), bindparam('cnpjs', expanding=True))
+
+
+def _digitos(valor):
+    return re.sub(r'\D', '', str(valor or ''))
+
+
+def formatar_cnpj(cnpj):
+    """CNPJ no formato gravado pelo cadastro (máscara do lead.html): 11.222.333/0001-81"""
+    d = _digitos(cnpj)
+    return f'{d[:2]}.{d[2:5]}.{d[5:8]}/{d[8:12]}-{d[12:]}'
+
+
+def _dv(numeros, pesos):
+    resto = sum(n * p for n, p in zip(numeros, pesos)) % 11
+    return 0 if resto < 2 else 11 - resto
+
+
+def validar_cnpjs(cnpjs):
+    """Validade dos dígitos verificadores de um lote de CNPJs (lista de bool)
+
+    Mesma regra do validarCNPJ do lead.html: 14 dígitos, não todos iguais
+    e os dois dígitos verificadores corretos.
+    """
+    validos = []
+    for cnpj in cnpjs:
+        d = _digitos(cnpj)
+        if len(d) != 14 or d == d[0] * 14:
+            validos.append(False)
+            continue
+        numeros = [int(c) for c in d]
+        validos.append(_dv(numeros, _PESOS_DV1) == numeros[12] and _dv(numeros, _PESOS_DV2) == numeros[13])
+    return validos
+
+
+def validar_cnpj(cnpj):
+    """Validade dos dígitos verificadores de um CNPJ"""
+    return validar_cnpjs([cnpj])[0]
+
+
+def ler_leads_csv(arquivo):
+    """Lê os leads de um CSV (Nome, E-mail, Telefone, CNPJ e NCM opcional) sem carregar o arquivo todo
+
+    `arquivo` é um arquivo de texto aberto. Gera (número da linha, lead).
+    """
+    leitor = csv.DictReader(arquivo)
+    for numero, row in enumerate(leitor, start=2):
+        lead = {}
+        for coluna, valor in row.items():
+            campo = _COLUNAS_CSV.get((coluna or '').strip().lower())
+            if campo:
+                lead[campo] = (valor or '').strip()
+        yield numero, lead
+
+
+def importar_leads(conn, linhas, tamanho=BATCH_SIZE):
+    """Valida, deduplica e insere os leads em blocos, uma transação por bloco
+
+    `linhas` são pares (número da linha, lead) como os de ler_leads_csv.
+    Retorna o resumo: importados, inválidos, duplicados e as primeiras
+    linhas rejeitadas com o motivo.
+    """
+    resumo = {'importados': 0, 'invalidos': 0, 'duplicados': 0, 'rejeitadas': []}
+    emails_vistos, cnpjs_vistos = set(), set()
+
+    def rejeitar(numero, motivo, contador):
+        resumo[contador] += 1
+        if len(resumo['rejeitadas']) < MAX_REJEITADAS:
+            resumo['rejeitadas'].append({'linha': numero, 'motivo': motivo})
+
+    for bloco in em_lotes(linhas, tamanho):
+        validos = validar_cnpjs(lead.get('cnpj') for _, lead in bloco)
+
+        candidatos = []
+        for (numero, lead), cnpj_valido in zip(bloco, validos):
+            faltando = [campo for campo in _CAMPOS_OBRIGATORIOS if not lead.get(campo)]
+            if faltando:
+                rejeitar(numero, f"Campo {faltando[0]} é obrigatório", 'invalidos')
+            elif '@' not in lead['email']:
+                rejeitar(numero, 'E-mail inválido', 'invalidos')
+            elif not cnpj_valido:
+                rejeitar(numero, 'CNPJ inválido', 'invalidos')
+            else:
+                lead['cnpj'] = formatar_cnpj(lead['cnpj'])
+                candidatos.append((numero, lead))
+
+        if not candidatos:
+            continue
+
+        existentes = conn.execute(_SQL_EXISTENTES, {
+            'emails': [lead['email'] for _, lead in candidatos],
+            'cnpjs': [lead['cnpj'] for _, lead in candidatos],
+        }).fetchall()
+        emails_banco = {row[0] for row in existentes}
+        cnpjs_banco = {row[1] for row in existentes}
+
+        novos = []
+        for numero, lead in candidatos:
+            if lead['email'] in emails_banco or lead['cnpj'] in cnpjs_banco:
+                rejeitar(numero, 'Lead já cadastrado (e-mail ou CNPJ)', 'duplicados')
+            elif lead['email'] in emails_vistos or lead['cnpj'] in cnpjs_vistos:
+                rejeitar(numero, 'Lead repetido no arquivo (e-mail ou CNPJ)', 'duplicados')
+            else:
+                emails_vistos.add(lead['email'])
+                cnpjs_vistos.add(lead['cnpj'])
+                novos.append({
+                    'nome': lead['nome'],
+                    'email': lead['email'],
+                    'telefone': lead['telefone'],
+                    'cnpj': lead['cnpj'],
+                    'senha': SENHA_PENDENTE,
+                    'ncm': normalizar_ncm(lead.get('ncm')),
+                })
+
+        if not novos:
+            continue
+
+        try:
+            conn.execute(_SQL_INSERT, novos)
+            conn.execute(_SQL_ENFILEIRAR, {'emails': [lead['email'] for lead in novos]})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        resumo['importados'] += len(novos)
+
+    return resumo
+
+
+def emails_pendentes(conn, limite, apos_id=0):
+    """Próximos emails pendentes da fila depois de `apos_id` (id, lead_id, nome, email, ncm)"""
+    rows = conn.execute(
+        text('''
+            SELECT q.id, q.lead_id, l.nome, l.email, l.ncm
+            FROM email_queue q JOIN leads l ON l.id = q.lead_id
+            WHERE q.status = 'pendente' AND q.id > :apos
+            ORDER BY q.id
+            LIMIT :limite
+        '''),
+        {'limite': limite, 'apos': apos_id}
+    ).fetchall()
+    return [dict(row._mapping) for row in rows]
+
+
+def definir_senha(conn, lead_id, senha_hash):
+    """Grava a senha de um lead importado; False se ele já tiver senha (email já processado)"""
+    result = conn.execute(
+        text('UPDATE leads SET senha = :senha WHERE id = :id AND senha = :pendente'),
+        {'senha': senha_hash, 'id': lead_id, 'pendente': SENHA_PENDENTE}
+    )
+    return result.rowcount == 1
+
+
+def marcar_email(conn, email_id, status, erro=None):
+    """Atualiza o status de um email da fila ('enviado', 'ignorado' ou nova tentativa em caso de falha)"""
+    if status == 'falha':
+        conn.execute(
+            text('''
+                UPDATE email_queue
+                SET tentativas = tentativas + 1, erro = :erro,
+                    status = CASE WHEN tentativas + 1 >= :max THEN 'erro' ELSE 'pendente' END
+                WHERE id = :id
+            '''),
+            {'id': email_id, 'erro': erro, 'max': MAX_TENTATIVAS}
+        )
+    else:
+        conn.execute(
+            text('UPDATE email_queue SET status = :status, processado_em = CURRENT_TIMESTAMP WHERE id = :id'),
+            {'id': email_id, 'status': status}
+        )
@@ -0,0 +1,33 @@
+"""Uso de memória do processo atual (RSS, compartilhada e privada)"""
+import os
+import resource
+import sys
+
+
+def uso_memoria():
+    """Retorna o uso de memória do processo em KB
+
+    No Linux lê /proc/self/smaps_rollup, que separa a memória compartilhada
+    com outros processos (ex: páginas herdadas do master no prefork) da
+    memória privada do processo. Nos demais sistemas retorna só o pico de RSS.
+    """
+    uso = {'pid': os.getpid()}
+
+    try:
+        with open('/proc/self/smaps_rollup') as arquivo:
+            campos = {}
+            for linha in arquivo:
+                partes = linha.split()
+                if len(partes) == 3 and partes[2] == 'kB':
+                    campos[partes[0].rstrip(':')] = int(partes[1])
+    except OSError:
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss é em bytes no macOS e em KB no Linux
+        uso['rss_max_kb'] = pico // 1024 if sys.platform == 'darwin' else pico
+        return uso
+
+    uso['rss_kb'] = campos.get('Rss', 0)
+    uso['pss_kb'] = campos.get('Pss', 0)
+    uso['compartilhada_kb'] = campos.get('Shared_Clean', 0) + campos.get('Shared_Dirty', 0)
+    uso['privada_kb'] = campos.get('Private_Clean', 0) + campos.get('Private_Dirty', 0)
+    return uso
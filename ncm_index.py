@@ -0,0 +1,394 @@
+"""Índice em memória da tabela NCM
+
+O índice é guardado em poucos objetos grandes (bytes e array) em vez de
+milhares de dicts e strings. Assim, em um servidor prefork (ver wsgi.py),
+as consultas dos workers não escrevem nas páginas herdadas do master (as
+contagens de referência ficam só no cabeçalho de cada buffer) e o dataset
+é compartilhado copy-on-write entre todos os workers.
+
+A tabela guarda todas as versões das regras, cada uma com seu período de
+vigência. Os registros ficam ordenados por (código, início da vigência),
+então as fronteiras de vigência de um código são contíguas e a regra em
+vigor em uma data é achada por busca binária, sem custo extra para as
+versões históricas.
+
+Layout:
+- `_chaves`: códigos NCM ordenados, cada um com largura fixa (completado com b'\\0')
+- `_campos`: uint32 com 4 ids de string por registro (descricao, cclasstrib, cst, descricao_cst)
+- `_inicio` / `_fim`: uint32 com a vigência de cada registro (date.toordinal(), fim exclusivo)
+- `_offsets` / `_textos`: tabela de strings únicas (internadas) em UTF-8
+
+O mesmo layout é gravado pelo import_csv.py em um snapshot compilado
+(`write_snapshot`), que a aplicação abre com mmap (`load_snapshot`) e
+consulta direto no arquivo, sem desserializar nada.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from normalizacao import ancestrais, com_zero_a_esquerda, normalizar_ncm
+
+CAMPOS = ('ncm', 'descricao', 'cclasstrib', 'cst', 'descricao_cst')
+
+# Campos de texto guardados na tabela de strings (todos menos o código)
+CAMPOS_TEXTO = CAMPOS[1:]
+
+# Campos de vigência (datas ISO; vigencia_fim exclusivo, NULL = em vigor)
+CAMPOS_VIGENCIA = ('vigencia_inicio', 'vigencia_fim')
+
+# Início da vigência das regras importadas sem data (vale desde sempre)
+VIGENCIA_INICIAL = '0001-01-01'
+
+# Fim de vigência em aberto
+_SEM_FIM = 0xFFFFFFFF
+
+# Snapshot compilado: cabeçalho seguido das seções chaves, campos, início e fim
+# da vigência, offsets e textos.
+# Cabeçalho: magic, formato, versão do dataset, total de registros, largura das
+# chaves, quantidade de offsets, tamanho dos textos, checksum do dataset e
+# SHA-256 do corpo.
+SNAPSHOT_MAGIC = b'NCMSNAP\0'
+SNAPSHOT_PATH_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ncm.snapshot')
+SNAPSHOT_FORMATO = 2
+_CABECALHO = struct.Struct('<8sIIIIII32s32s')
+
+
+class SnapshotInvalido(ValueError):
+    """Snapshot ausente, de outro formato ou corrompido"""
+
+
+def _alinhar(tamanho):
+    """Completa o tamanho até o próximo múltiplo de 4 (alinhamento dos uint32)"""
+    return (tamanho + 3) & ~3
+
+
+def _ordinal(data):
+    """Data (date ou texto ISO) como número de dias, como em date.toordinal()"""
+    if isinstance(data, str):
+        data = date.fromisoformat(data)
+    return data.toordinal()
+
+
+def checksum_registros(registros):
+    """SHA-256 dos registros na ordem de importação (identifica o conteúdo do dataset)"""
+    digest = hashlib.sha256()
+    for registro in registros:
+        valores = (registro[campo] or '' for campo in CAMPOS + CAMPOS_VIGENCIA)
+        digest.update('\x1f'.join(valores).encode('utf-8'))
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+def ler_registros(conn):
+    """Todos os registros da tabela ncm (todas as vigências) na ordem de importação"""
+    rows = conn.execute(
+        text(f'SELECT {", ".join(CAMPOS + CAMPOS_VIGENCIA)} FROM ncm ORDER BY id')
+    ).fetchall()
+    return [dict(row._mapping) for row in rows]
+
+
+def migrar_vigencias(conn):
+    """Acrescenta as colunas de vigência a uma tabela ncm criada antes delas (idempotente)
+
+    As linhas existentes passam a valer desde sempre e sem fim. Roda no
+    import_csv.py e no warm-up da aplicação, para que o código novo funcione
+    contra um banco ainda no esquema antigo. Retorna True se alterou a tabela
+    (o commit fica com quem chamou).
+    """
+    colunas = {row[1] for row in conn.execute(text('PRAGMA table_info(ncm)'))}
+    if not colunas or {'vigencia_inicio', 'vigencia_fim'} <= colunas:
+        return False
+
+    if 'vigencia_inicio' not in colunas:
+        conn.execute(text(
+            f"ALTER TABLE ncm ADD COLUMN vigencia_inicio TEXT NOT NULL DEFAULT '{VIGENCIA_INICIAL}'"
+        ))
+    if 'vigencia_fim' not in colunas:
+        conn.execute(text('ALTER TABLE ncm ADD COLUMN vigencia_fim TEXT'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS idx_ncm_vigencia ON ncm(ncm, vigencia_inicio)'))
+    return True
+
+
+def ler_versao_dataset(conn):
+    """Última versão registrada pelo import_csv.py, ou None se não houver"""
+    try:
+        row = conn.execute(
+            text('SELECT versao, linhas, checksum FROM dataset_meta ORDER BY versao DESC LIMIT 1')
+        ).fetchone()
+    except DBAPIError:
+        # Banco importado antes da tabela dataset_meta existir
+        conn.rollback()
+        return None
+    return dict(row._mapping) if row else None
+
+
+class NcmIndex:
+    """Índice somente leitura dos NCMs: busca exata e por prefixo sem ir ao banco"""
+
+    __slots__ = ('versao', 'checksum', 'origem', '_chaves', '_largura', '_total',
+                 '_campos', '_inicio', '_fim', '_offsets', '_textos')
+
+    def __init__(self, registros, versao=0, checksum=None):
+        self.versao = versao
+        self.checksum = checksum
+        self.origem = 'banco'
+
+        registros = list(registros)
+        inicios = [_ordinal(r.get('vigencia_inicio') or VIGENCIA_INICIAL) for r in registros]
+        fins = [_ordinal(r['vigencia_fim']) if r.get('vigencia_fim') else _SEM_FIM for r in registros]
+
+        # Ordena por (código, início da vigência); dentro de uma mesma versão,
+        # mantém a ordem de importação (o primeiro registro é o que vale)
+        ordem = sorted(range(len(registros)), key=lambda i: (registros[i]['ncm'], inicios[i], i))
+        chaves = [registros[i]['ncm'].encode('utf-8') for i in ordem]
+        largura = max((len(chave) for chave in chaves), default=1)
+
+        # Interna as strings: cada texto distinto é guardado uma única vez
+        ids = {}
+        textos = bytearray()
+        offsets = array('I', [0])
+        campos = array('I')
+        for i in ordem:
+            for campo in CAMPOS_TEXTO:
+                valor = registros[i][campo] or ''
+                if valor not in ids:
+                    ids[valor] = len(offsets) - 1
+                    textos += valor.encode('utf-8')
+                    offsets.append(len(textos))
+                campos.append(ids[valor])
+
+        self._chaves = memoryview(b''.join(chave.ljust(largura, b'\0') for chave in chaves))
+        self._largura = largura
+        self._total = len(ordem)
+        self._campos = memoryview(campos)
+        self._inicio = memoryview(array('I', (inicios[i] for i in ordem)))
+        self._fim = memoryview(array('I', (fins[i] for i in ordem)))
+        self._offsets = memoryview(offsets)
+        self._textos = memoryview(bytes(textos))
+
+    @classmethod
+    def from_connection(cls, conn):
+        """Carrega todos os NCMs do banco na ordem de importação
+
+        Confere a quantidade de linhas e o checksum com a versão registrada em
+        `dataset_meta`, garantindo que o índice corresponde exatamente a ela.
+        """
+        meta = ler_versao_dataset(conn)
+        registros = ler_registros(conn)
+        checksum = checksum_registros(registros)
+
+        if meta is None:
+            return cls(registros, versao=0, checksum=checksum)
+
+        if len(registros) != meta['linhas'] or checksum != meta['checksum']:
+            raise ValueError(f"Tabela ncm não corresponde à versão {meta['versao']} do dataset")
+        return cls(registros, versao=meta['versao'], checksum=checksum)
+
+    def write_snapshot(self, path):
+        """Grava o índice como snapshot compilado
+
+        O arquivo é escrito ao lado e renomeado no final: processos que já
+        mapearam o snapshot anterior continuam lendo o arquivo antigo.
+        """
+        chaves = self._chaves.tobytes()
+        corpo = b''.join((
+            chaves.ljust(_alinhar(len(chaves)), b'\0'),
+            _uint32_le(self._campos),
+            _uint32_le(self._inicio),
+            _uint32_le(self._fim),
+            _uint32_le(self._offsets),
+            self._textos.tobytes(),
+        ))
+        cabecalho = _CABECALHO.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_FORMATO, self.versao, self._total, self._largura,
+            len(self._offsets), len(self._textos),
+            bytes.fromhex(self.checksum or '0' * 64), hashlib.sha256(corpo).digest()
+        )
+
+        temporario = f'{path}.tmp'
+        with open(temporario, 'wb') as arquivo:
+            arquivo.write(cabecalho)
+            arquivo.write(corpo)
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        os.replace(temporario, path)
+
+    @classmethod
+    def load_snapshot(cls, path):
+        """Abre um snapshot compilado com mmap, sem copiar os dados para a memória do processo
+
+        Levanta SnapshotInvalido se o arquivo não existir, for de outro formato
+        ou estiver corrompido (SHA-256 do corpo diferente do cabeçalho).
+        """
+        if sys.byteorder != 'little' or array('I').itemsize != 4:
+            raise SnapshotInvalido("Snapshot só pode ser mapeado em plataformas little-endian com uint32 de 4 bytes")
+
+        try:
+            with open(path, 'rb') as arquivo:
+                mapa = mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise SnapshotInvalido(f"Não foi possível abrir o snapshot {path}: {e}") from e
+
+        if len(mapa) < _CABECALHO.size:
+            raise SnapshotInvalido(f"Snapshot {path} truncado")
+        (magic, formato, versao, total, largura, n_offsets, n_textos,
+         checksum, sha256_corpo) = _CABECALHO.unpack_from(mapa)
+        if magic != SNAPSHOT_MAGIC or formato != SNAPSHOT_FORMATO:
+            raise SnapshotInvalido(f"Snapshot {path} de formato desconhecido")
+
+        buffer = memoryview(mapa)[_CABECALHO.size:]
+        inicio_campos = _alinhar(total * largura)
+        inicio_vigencias = inicio_campos + total * len(CAMPOS_TEXTO) * 4
+        inicio_fins = inicio_vigencias + total * 4
+        inicio_offsets = inicio_fins + total * 4
+        inicio_textos = inicio_offsets + n_offsets * 4
+        if len(buffer) != inicio_textos + n_textos:
+            raise SnapshotInvalido(f"Snapshot {path} truncado")
+        if hashlib.sha256(buffer).digest() != sha256_corpo:
+            raise SnapshotInvalido(f"Snapshot {path} corrompido (checksum não confere)")
+
+        indice = cls.__new__(cls)
+        indice.versao = versao
+        indice.checksum = checksum.hex()
+        indice.origem = 'snapshot'
+        indice._chaves = buffer[:total * largura]
+        indice._largura = largura
+        indice._total = total
+        indice._campos = buffer[inicio_campos:inicio_vigencias].cast('I')
+        indice._inicio = buffer[inicio_vigencias:inicio_fins].cast('I')
+        indice._fim = buffer[inicio_fins:inicio_offsets].cast('I')
+        indice._offsets = buffer[inicio_offsets:inicio_textos].cast('I')
+        indice._textos = buffer[inicio_textos:]
+        return indice
+
+    def __len__(self):
+        return self._total
+
+    def nbytes(self):
+        """Tamanho dos buffers do índice (em memória ou mapeados do snapshot)"""
+        return (self._chaves.nbytes + self._campos.nbytes + self._inicio.nbytes
+                + self._fim.nbytes + self._offsets.nbytes + self._textos.nbytes)
+
+    def _chave(self, i):
+        largura = self._largura
+        return self._chaves[i * largura:(i + 1) * largura].tobytes()
+
+    def _texto(self, i):
+        return str(self._textos[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+
+    def _registro(self, i):
+        registro = {'ncm': self._chave(i).rstrip(b'\0').decode('utf-8')}
+        base = i * len(CAMPOS_TEXTO)
+        for j, campo in enumerate(CAMPOS_TEXTO):
+            registro[campo] = self._texto(self._campos[base + j])
+        registro['vigencia_inicio'] = date.fromordinal(self._inicio[i]).isoformat()
+        registro['vigencia_fim'] = (
+            date.fromordinal(self._fim[i]).isoformat() if self._fim[i] != _SEM_FIM else None
+        )
+        return registro
+
+    def _bisect(self, chave, lo=0, direita=False):
+        """Busca binária nas chaves (já completadas até a largura fixa)
+
+        Retorna a primeira posição cuja chave é >= `chave` ou, com
+        `direita=True`, a primeira cuja chave é > `chave`.
+        """
+        hi = self._total
+        while lo < hi:
+            mid = (lo + hi) // 2
+            atual = self._chave(mid)
+            if atual < chave or (direita and atual == chave):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _vigente(self, lo, hi, dia):
+        """Primeiro registro em vigor no `dia` entre os registros [lo, hi) de um mesmo código"""
+        # Última versão que começou até o dia...
+        j = bisect_right(self._inicio, dia, lo, hi) - 1
+        if j < lo:
+            return None
+        # ...e o primeiro registro dessa versão
+        j = bisect_left(self._inicio, self._inicio[j], lo, j)
+        return j if self._fim[j] > dia else None
+
+    def _buscar_prefixo(self, prefixo, dia, exato=False):
+        """Primeiro registro em vigor cujo código é `prefixo` ou começa com ele"""
+        prefixo = prefixo.encode('utf-8')
+        if len(prefixo) > self._largura:
+            return None
+
+        completo = prefixo.ljust(self._largura, b'\0')
+        i = self._bisect(completo)
+        while i < self._total and self._chave(i).startswith(prefixo):
+            chave = self._chave(i)
+            if exato and chave != completo:
+                return None
+            fim_chave = self._bisect(chave, lo=i, direita=True)
+            j = self._vigente(i, fim_chave, dia)
+            if j is not None:
+                return j
+            i = fim_chave
+        return None
+
+    def buscar(self, codigo, data=None):
+        """Busca a regra de um NCM em vigor na data (hoje, se omitida)
+
+        Ordem: código exato; o primeiro NCM que começa com o código; o
+        código com o zero à esquerda restaurado (ex: 711 -> 0711, só exato);
+        a regra do nível superior mais específico (ex: 10063011 -> 100630).
+        """
+        codigo = normalizar_ncm(codigo)
+        if not codigo:
+            return None
+        dia = _ordinal(data or date.today())
+
+        i = self._buscar_prefixo(codigo, dia)
+        if i is None and com_zero_a_esquerda(codigo) != codigo:
+            i = self._buscar_prefixo(com_zero_a_esquerda(codigo), dia, exato=True)
+        if i is not None:
+            return self._registro(i)
+
+        for ancestral in ancestrais(codigo):
+            i = self._buscar_prefixo(ancestral, dia, exato=True)
+            if i is not None:
+                return self._registro(i)
+        return None
+
+    def regras_vigentes(self, data=None):
+        """Regra em vigor na data para cada código: {codigo: (descricao, cclasstrib, cst, descricao_cst)}"""
+        dia = _ordinal(data or date.today())
+        regras = {}
+        i = 0
+        while i < self._total:
+            chave = self._chave(i)
+            fim_chave = self._bisect(chave, lo=i, direita=True)
+            j = self._vigente(i, fim_chave, dia)
+            if j is not None:
+                registro = self._registro(j)
+                regras[registro['ncm']] = tuple(registro[campo] for campo in CAMPOS_TEXTO)
+            i = fim_chave
+        return regras
+
+    def proxima_vigencia(self, data=None):
+        """Data (ISO) em que começa a próxima versão das regras depois de `data`, ou None"""
+        dia = _ordinal(data or date.today())
+        proxima = min((inicio for inicio in self._inicio if inicio > dia), default=None)
+        return date.fromordinal(proxima).isoformat() if proxima is not None else None
+
+
+def _uint32_le(valores):
+    """Serializa uma sequência de uint32 em little-endian"""
+    dados = array('I', valores)
+    if sys.byteorder != 'little':
+        dados.byteswap()
+    return dados.tobytes()
@@ -0,0 +1,87 @@
+"""Normalização dos códigos NCM
+
+Usada tanto no import_csv.py (limpeza da planilha) quanto nas consultas,
+para que toda busca seja por uma chave canônica: só dígitos, sem pontos,
+espaços ou quebras de linha. Na planilha, o zero à esquerda perdido de
+capítulos e posições é restaurado no import; nas consultas, um código
+digitado é buscado primeiro como prefixo e só depois com o zero.
+"""
+import re
+
+# Separadores de células com mais de um código, ex: "8802 e 8806"
+_SEPARADORES = re.compile(r'\s+e\s+|[,;/]|\s+')
+
+# Faixas declaradas na descrição, ex: "Arroz das subposições 1006.20 a 1006.30"
+_FAIXA = re.compile(r'(\d{4}(?:\.\d{1,2}){1,2})\s+a\s+(\d{4}(?:\.\d{1,2}){1,2})')
+
+# Limite de códigos gerados por uma única faixa (protege contra faixas mal digitadas)
+MAX_CODIGOS_FAIXA = 100
+
+
+def normalizar_ncm(codigo):
+    """Forma canônica de um código NCM digitado: só os dígitos ("1006.30.00" -> "10063000")"""
+    return re.sub(r'\D', '', codigo or '')
+
+
+def com_zero_a_esquerda(codigo):
+    """Código com o zero à esquerda perdido na planilha ("711" -> "0711", "7" -> "07")
+
+    Capítulos e posições têm 2 e 4 dígitos; na planilha, "7" e "711" são
+    o capítulo 07 e a posição 0711. Códigos de outros tamanhos não mudam.
+    """
+    if len(codigo) in (1, 3):
+        return '0' + codigo
+    return codigo
+
+
+def _normalizar_celula(parte):
+    """Normaliza um código vindo da planilha, restaurando o zero à esquerda perdido"""
+    return com_zero_a_esquerda(normalizar_ncm(parte))
+
+
+def expandir_faixa(inicio, fim):
+    """Códigos de uma faixa "1006.20 a 1006.30" no mesmo nível da NCM
+
+    O passo segue os zeros finais dos extremos: entre 1006.20 e 1006.30 só
+    existem as subposições 100620 e 100630.
+    """
+    inicio, fim = normalizar_ncm(inicio), normalizar_ncm(fim)
+    if len(inicio) != len(fim) or inicio > fim:
+        return []
+
+    zeros = min(len(inicio) - len(inicio.rstrip('0')), len(fim) - len(fim.rstrip('0')))
+    passo = 10 ** zeros
+    codigos = range(int(inicio), int(fim) + 1, passo)
+    if len(codigos) > MAX_CODIGOS_FAIXA:
+        return []
+    return [str(codigo).zfill(len(inicio)) for codigo in codigos]
+
+
+def expandir_celula(ncm, descricao=''):
+    """Chaves canônicas de uma linha da planilha
+
+    Separa células com vários códigos ("8802 e 8806"), remove pontos e
+    quebras de linha ("\\n89061000") e acrescenta os códigos das faixas
+    declaradas na descrição. Linhas sem código (ex: "-", a regra padrão)
+    retornam [''].
+    """
+    chaves = []
+    for parte in _SEPARADORES.split((ncm or '').strip()):
+        chave = _normalizar_celula(parte)
+        if chave and chave not in chaves:
+            chaves.append(chave)
+
+    for inicio, fim in _FAIXA.findall(descricao or ''):
+        for chave in expandir_faixa(inicio, fim):
+            if chave not in chaves:
+                chaves.append(chave)
+
+    return chaves or ['']
+
+
+def ancestrais(codigo):
+    """Códigos dos níveis superiores, do mais específico ao capítulo ("100630" -> "10063", "1006", "10")
+
+    Os níveis da NCM têm 2, 4, 5, 6, 7 e 8 dígitos; 3 dígitos não é um nível.
+    """
+    return [codigo[:tamanho] for tamanho in range(len(codigo) - 1, 1, -1) if tamanho != 3]
@@ -0,0 +1,22 @@
+"""Entry point multi-processo (prefork) da aplicação
+
+Uso: gunicorn -c gunicorn.conf.py wsgi:app
+
+Com `preload_app = True` este módulo é importado uma única vez no master,
+antes do fork: o warm-up carrega os NCMs em memória, o gc.freeze() tira
+esses objetos do alcance do coletor de lixo e os workers herdam as
+páginas copy-on-write. A conexão aberta no warm-up é fechada antes do fork
+para que cada worker abra a sua.
+"""
+import gc
+
+from app import create_app, release_connections
+
+app = create_app()
+
+# Nenhum worker deve reutilizar o socket do master
+release_connections(app)
+
+# Move tudo o que foi carregado até aqui para a geração permanente do GC,
+# evitando que as coletas nos workers escrevam nas páginas compartilhadas
+gc.freeze()